@@ -12,5 +12,9 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'books.settings')
+# В ASGI синхронный ORM работает в потоках sync_to_async: постоянные
+# соединения привязаны к потоку, поэтому по умолчанию используем пул
+os.environ.setdefault('DB_POOL_SIZE', '10')
+os.environ.setdefault('BOOKS_ASYNC_READS', '1')
 
 application = get_asgi_application()
@@ -0,0 +1,149 @@
+import threading
+
+import psycopg2
+from django.db import OperationalError
+from django.db.backends.postgresql import base
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+# Пулы соединений процесса по параметрам подключения (у тестовой БД
+# другое имя - и свой пул)
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """Пул соединений psycopg2 в памяти процесса.
+
+    Не больше max_size соединений одновременно: если все заняты, get() ждет
+    освобождения до timeout секунд и падает с OperationalError. Свободные
+    соединения переиспользуются в порядке LIFO, чтобы лишние
+    простаивали и их можно было закрыть на стороне сервера. С check=True
+    свободное соединение перед выдачей проверяется SELECT 1: разорванное
+    сервером (перезапуск, таймаут простоя) закрывается, и берется
+    следующее.
+    """
+
+    def __init__(self, max_size, timeout, check=True):
+        self.timeout = timeout
+        self.check = check
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self, connect):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise OperationalError(
+                f'Connection pool exhausted (waited {self.timeout}s)')
+        try:
+            while True:
+                with self._lock:
+                    connection = self._idle.pop() if self._idle else None
+                if connection is None:
+                    return connect()
+                if connection.closed:
+                    continue
+                if not self.check or self.is_alive(connection):
+                    return connection
+                connection.close()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    @staticmethod
+    def is_alive(connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if connection.get_transaction_status() != \
+                    TRANSACTION_STATUS_IDLE:
+                # Без autocommit SELECT открыл транзакцию
+                connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def put(self, connection):
+        try:
+            if connection.closed:
+                return
+            if connection.get_transaction_status() != \
+                    TRANSACTION_STATUS_IDLE:
+                # Незавершенная или сломанная транзакция - соединение не
+                # возвращаем
+                connection.close()
+                return
+            with self._lock:
+                self._idle.append(connection)
+        finally:
+            self._slots.release()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """PostgreSQL backend с проверкой постоянных соединений и
+    необязательным пулом.
+
+    CONN_HEALTH_CHECKS (как в Django 4.1): соединение, оставшееся от
+    прошлого запроса (CONN_MAX_AGE > 0), перед первым использованием в
+    новом запросе проверяется SELECT 1 и при ошибке переоткрывается, а не
+    роняет запрос. С пулом так же проверяется соединение, взятое из пула.
+
+    POOL = {'MAX_SIZE': ..., 'TIMEOUT': ...}: соединения берутся из пула
+    процесса и возвращаются в него вместо закрытия (для ASGI, где запросы
+    обслуживают разные потоки). С пулом CONN_MAX_AGE обычно 0: соединение
+    возвращается в пул в конце каждого запроса.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.health_check_enabled = self.settings_dict.get(
+            'CONN_HEALTH_CHECKS', False)
+        self.health_check_done = False
+
+    def get_pool(self, conn_params):
+        options = self.settings_dict.get('POOL')
+        if not options or not options.get('MAX_SIZE'):
+            return None
+        key = tuple(sorted((name, str(value))
+                           for name, value in conn_params.items()))
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(
+                    options['MAX_SIZE'], options.get('TIMEOUT', 10),
+                    check=self.health_check_enabled)
+        return pool
+
+    def get_new_connection(self, conn_params):
+        self._pool = self.get_pool(conn_params)
+        if self._pool is None:
+            return super().get_new_connection(conn_params)
+        return self._pool.get(
+            lambda: super(DatabaseWrapper, self).get_new_connection(
+                conn_params)
+        )
+
+    def connect(self):
+        # Новое соединение проверять не нужно (и нельзя посреди его
+        # инициализации)
+        self.health_check_done = True
+        super().connect()
+
+    def ensure_connection(self):
+        if self.connection is not None and self.health_check_enabled and \
+                not self.health_check_done:
+            if not self.is_usable():
+                self.close()
+            self.health_check_done = True
+        super().ensure_connection()
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # Следующий запрос снова проверит соединение перед использованием
+        self.health_check_done = False
+
+    def _close(self):
+        pool = getattr(self, '_pool', None)
+        if pool is None or self.connection is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            pool.put(self.connection)
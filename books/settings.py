@@ -30,10 +30,6 @@ DEBUG = True
 
 ALLOWED_HOSTS = []
 
-INTERNAL_IPS = [
-    "127.0.0.1",
-]
-
 # Application definition
 
 INSTALLED_APPS = [
@@ -44,7 +40,6 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
 
-    "debug_toolbar",
     'social_django',
 
     'store',
@@ -59,8 +54,8 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
-    "debug_toolbar.middleware.DebugToolbarMiddleware",
-    'debug_toolbar_force.middleware.ForceDebugToolbarMiddleware',
+    # Server-Timing и гистограммы времени по маршрутам (см. /metrics/)
+    'store.middleware.PerformanceMiddleware',
 ]
 
 ROOT_URLCONF = 'books.urls'
@@ -93,14 +88,31 @@ WSGI_APPLICATION = 'books.wsgi.application'
 #     }
 # }
 
+# Соединения с БД (books/db_backends/postgresql):
+# DB_POOL_SIZE > 0 - пул соединений процесса (по умолчанию в ASGI, см.
+# books/asgi.py), соединение возвращается в пул после каждого запроса;
+# иначе постоянные соединения на DB_CONN_MAX_AGE секунд. DB_POOL_TIMEOUT -
+# сколько секунд ждать свободное соединение пула.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 0))
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'books.db_backends.postgresql',
         'NAME': 'books_db',
         'USER': 'app',
         'PASSWORD': 'secret',
         'HOST': 'localhost',
         'PORT': '5432',
+        'CONN_MAX_AGE': int(os.environ.get(
+            'DB_CONN_MAX_AGE', 0 if DB_POOL_SIZE else 60)),
+        # Постоянное соединение проверяется перед первым запросом к БД в
+        # каждом HTTP запросе
+        'CONN_HEALTH_CHECKS': os.environ.get(
+            'DB_CONN_HEALTH_CHECKS', '1') == '1',
+        'POOL': {
+            'MAX_SIZE': DB_POOL_SIZE,
+            'TIMEOUT': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        },
     }
 }
 
@@ -155,8 +167,45 @@ REST_FRAMEWORK = {
     ),
     'DEFAULT_PARSER_CLASSES': (
         'rest_framework.parsers.JSONParser',
-    )
+    ),
+    # Keyset пагинация: страница = range scan по индексу вместо OFFSET
+    'DEFAULT_PAGINATION_CLASS': 'store.pagination.KeysetPagination',
+    'PAGE_SIZE': 20,
+}
+
+# Кэш ответов GET /book/ и /book/{id}/ (store.cache). Второй вариант
+# BACKEND - 'store.cache.DjangoCacheBackend' с OPTIONS {'cache_alias': ...},
+# чтобы кэш и версии были общими для всех процессов. BACKEND None -
+# кэш выключен
+BOOKS_RESPONSE_CACHE = {
+    'BACKEND': 'store.cache.LocMemLRUBackend',
+    'OPTIONS': {
+        'max_entries': 1024,
+    },
+    # Время жизни записи, секунды
+    'TIMEOUT': 60,
+    # Ответы больше этого размера (байт) не кэшируются
+    'MAX_ENTRY_SIZE': 1024 * 1024,
 }
+
+# Отложенная запись PATCH /book_relation/{id}/ (store.writebehind):
+# изменения копятся в процессе и пишутся пачками раз в FLUSH_INTERVAL
+# секунд или при MAX_PENDING парах (пользователь, книга). JOURNAL_DIR -
+# каталог журналов, чтобы изменения пережили падение процесса. None -
+# запись синхронная
+BOOKS_WRITE_BEHIND = None
+if os.environ.get('BOOKS_WRITE_BEHIND') == '1':
+    BOOKS_WRITE_BEHIND = {
+        'FLUSH_INTERVAL': 1.0,
+        'MAX_PENDING': 500,
+        'JOURNAL_DIR': os.environ.get('BOOKS_WRITE_BEHIND_JOURNAL_DIR'),
+    }
+
+# GET /book/ и /book/{id}/ через async view (store/async_views.py): ответы
+# из кэша - без потока, остальное - в общем пуле потоков. Включается в
+# books/asgi.py, под WSGI смысла не имеет
+BOOKS_ASYNC_READS = os.environ.get('BOOKS_ASYNC_READS') == '1'
+
 # --------------- Python Social Auth settings ---------------
 # When using PostgreSQL, it’s recommended to use the
 # built-in JSONB field to store the extracted extra_data.
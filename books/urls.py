@@ -18,7 +18,7 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import SimpleRouter
 
-from store.views import BookViewSet, auth, UserBooksRelationView
+from store.views import BookViewSet, auth, metrics, UserBooksRelationView
 
 # Получаем роутер DRF
 router = SimpleRouter()
@@ -31,14 +31,14 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('social_django.urls', namespace='social')),
     path('auth/', auth),
+    path('metrics/', metrics, name='metrics'),
 ]
 
-# Добавляем в urlpatterns маршруты из роутера DRF
-urlpatterns += router.urls
+# Async чтение книг перекрывает маршруты роутера для /book/ и /book/{id}/
+if settings.BOOKS_ASYNC_READS:
+    from store import async_views
 
-if settings.DEBUG:
-    import debug_toolbar
+    urlpatterns += async_views.urlpatterns
 
-    urlpatterns += [
-        path('__debug__/', include('debug_toolbar.urls')),
-    ]
+# Добавляем в urlpatterns маршруты из роутера DRF
+urlpatterns += router.urls
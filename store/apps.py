@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class StoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'store'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        # Подключаем обработчики сигналов моделей
+        from store import signals  # noqa: F401
+        from store.middleware import install_query_timer
+
+        # Счетчик SQL запросов PerformanceMiddleware на каждом соединении
+        connection_created.connect(install_query_timer)
@@ -0,0 +1,89 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.urls import re_path
+
+from store.cache import entry_response, get_response_cache
+from store.views import BookViewSet
+
+# Чтение книг под ASGI (BOOKS_ASYNC_READS, см. books/asgi.py).
+#
+# Ответ из кэша ответов процесса (LocMemLRUBackend) отдается прямо в
+# event loop, без потока. При промахе и для остальных методов работает
+# обычный BookViewSet - с теми же разрешениями, фильтрами, пагинацией и
+# сериализацией, - но в общем пуле потоков (thread_sensitive=False), а не в
+# единственном потоке sync_to_async по умолчанию: медленные клиенты и
+# попадания в кэш не занимают потоки, а запросы к БД идут параллельно
+# (соединения берутся из пула, см. books/db_backends).
+#
+# В Django 4.0 нет async ORM (aget, aiterator), поэтому сам запрос к БД
+# остается синхронным.
+
+# detail задается так же, как это делает роутер: по нему BookViewSet
+# выбирает версию для ETag (книги или списка)
+book_list_view = BookViewSet.as_view({'get': 'list', 'post': 'create'},
+                                     detail=False)
+book_detail_view = BookViewSet.as_view({
+    'get': 'retrieve',
+    'put': 'update',
+    'patch': 'partial_update',
+    'delete': 'destroy',
+}, detail=True)
+
+
+def _call_view(view, request, *args, **kwargs):
+    try:
+        return view(request, *args, **kwargs)
+    finally:
+        # В потоках пула нет сигналов request_started/request_finished:
+        # соединение закрывается (возвращается в пул) или проверяется здесь.
+        # Открытую транзакцию (TestCase) не трогаем
+        for connection in connections.all():
+            if not connection.in_atomic_block:
+                connection.close_if_unusable_or_obsolete()
+
+
+async def run_view(view, request, *args, **kwargs):
+    thread_sensitive = getattr(settings, 'BOOKS_ASYNC_THREAD_SENSITIVE',
+                               False)
+    return await sync_to_async(_call_view, thread_sensitive=thread_sensitive)(
+        view, request, *args, **kwargs
+    )
+
+
+def cached_response(request, make_key):
+    """Ответ из кэша без БД и без потока или None"""
+    if request.method != 'GET':
+        return None
+    response_cache = get_response_cache()
+    if response_cache is None or response_cache.backend.blocking:
+        return None
+    entry = response_cache.get(make_key(response_cache))
+    if entry is None:
+        return None
+    return entry_response(request, entry)
+
+
+async def book_list(request):
+    response = cached_response(
+        request, lambda cache: cache.list_key(request.GET))
+    if response is not None:
+        return response
+    return await run_view(book_list_view, request)
+
+
+async def book_detail(request, pk):
+    response = cached_response(
+        request, lambda cache: cache.detail_key(pk, request.GET))
+    if response is not None:
+        return response
+    return await run_view(book_detail_view, request, pk=pk)
+
+
+# Те же адреса и имена, что у маршрутов роутера DRF для BookViewSet;
+# подключаются перед router.urls. pk - только число: иначе маршрут
+# перехватил бы действия списка (/book/stream/, /book/import/, ...)
+urlpatterns = [
+    re_path(r'^book/$', book_list, name='book-list'),
+    re_path(r'^book/(?P<pk>\d+)/$', book_detail, name='book-detail'),
+]
@@ -0,0 +1,143 @@
+import json
+import random
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from store.logic import reconcile_likes_count, reconcile_rating
+from store.models import Book, UserBookRelation
+from store.search import update_search_index
+
+# Параметры набора данных по умолчанию (маленький набор для тестов)
+DEFAULT_PARAMS = {
+    'books': 60,
+    'users': 30,
+    'fanout': 5,
+    'skew': 1.0,
+    'seed': 0,
+}
+
+
+def seed_data(books, users, fanout, skew=1.0, seed=0):
+    """Заполняет БД книгами, пользователями и связями между ними.
+
+    Каждый пользователь связан с fanout разными книгами. Популярность
+    книги с номером i пропорциональна 1 / (i + 1) ** skew: при skew=0 связи
+    распределены равномерно, чем больше skew, тем сильнее они
+    сосредоточены на первых книгах. Счетчики книг пересчитываются в конце
+    одним reconcile. Возвращает (книги, пользователи)."""
+    rng = random.Random(seed)
+    authors = [f'Author {number}' for number in range(max(books // 5, 1))]
+    book_objects = Book.objects.bulk_create(
+        Book(name=f'Book {number} {rng.choice(("red", "green", "blue"))}',
+             price=rng.randint(100, 100000) / 100,
+             author_name=rng.choice(authors))
+        for number in range(books)
+    )
+    update_search_index(book_objects)
+    user_objects = User.objects.bulk_create(
+        User(username=f'bench_user_{number}',
+             first_name=f'First {number}',
+             last_name=f'Last {number}')
+        for number in range(users)
+    )
+
+    weights = [1 / (number + 1) ** skew for number in range(books)]
+    fanout = min(fanout, books)
+    relations = []
+    for user in user_objects:
+        chosen = set()
+        while len(chosen) < fanout:
+            chosen.update(rng.choices(range(books), weights,
+                                      k=fanout - len(chosen)))
+        for index in sorted(chosen):
+            relations.append(UserBookRelation(
+                user=user,
+                book=book_objects[index],
+                like=rng.random() < 0.3,
+                in_bookmarks=rng.random() < 0.1,
+                rate=rng.choice((None, None, 1, 2, 3, 4, 5))
+            ))
+    UserBookRelation.objects.bulk_create(relations, batch_size=1000)
+    reconcile_likes_count()
+    reconcile_rating()
+    return book_objects, user_objects
+
+
+def get_scenarios(books):
+    """(имя, метод, url, параметры/тело, нужен ли логин) сценариев"""
+    book = books[0]
+    return [
+        ('book-list', 'get', reverse('book-list'), {}, False),
+        ('book-list-ordering', 'get', reverse('book-list'),
+         {'ordering': '-price'}, False),
+        ('book-list-search', 'get', reverse('book-list'),
+         {'search': 'green'}, False),
+        ('book-list-readers-preview', 'get', reverse('book-list'),
+         {'readers_limit': 3}, False),
+        ('book-detail', 'get', reverse('book-detail', args=(book.id,)), {},
+         False),
+        ('userbookrelation-detail', 'patch',
+         reverse('userbookrelation-detail', args=(book.id,)),
+         {'like': True, 'rate': 5}, True),
+    ]
+
+
+def measure(client, method, url, data):
+    """Число SQL запросов, время, пик памяти и размер ответа. Память
+    меряется отдельным повтором запроса: tracemalloc сильно замедляет
+    выполнение и исказил бы время"""
+    if method == 'get':
+        kwargs = {'data': data}
+    else:
+        kwargs = {'data': json.dumps(data),
+                  'content_type': 'application/json'}
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        response = getattr(client, method)(url, **kwargs)
+        elapsed = time.perf_counter() - started
+    # Следующий запрос очистит connection.queries (reset_queries).
+    # SAVEPOINT не считаем: вне транзакции теста на их месте BEGIN/COMMIT,
+    # которые Django не логирует, и числа в тесте и в команде разошлись бы
+    query_count = sum(
+        1 for query in queries.captured_queries
+        if 'SAVEPOINT' not in query['sql']
+    )
+
+    tracemalloc.start()
+    try:
+        getattr(client, method)(url, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'status': response.status_code,
+        'queries': query_count,
+        'time_ms': round(elapsed * 1000, 2),
+        'peak_kb': round(peak / 1024, 1),
+        'size': len(response.content),
+    }
+
+
+@override_settings(BOOKS_RESPONSE_CACHE=None)
+def run_benchmarks(params=None):
+    """Заполняет БД по params (DEFAULT_PARAMS) и прогоняет сценарии через
+    тестовый клиент. БД должна быть тестовой. Возвращает
+    {'vendor': ..., 'params': ..., 'scenarios': {имя: метрики}}."""
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    books, users = seed_data(**params)
+    client = APIClient()
+    client.force_login(users[0])
+    anonymous = APIClient()
+    results = {}
+    for name, method, url, data, login in get_scenarios(books):
+        results[name] = measure(client if login else anonymous, method, url,
+                                data)
+    return {'vendor': connection.vendor, 'params': params,
+            'scenarios': results}
@@ -0,0 +1,240 @@
+import itertools
+import random
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.utils.module_loading import import_string
+
+# Имена версий: одна на весь список книг и по одной на каждую книгу
+BOOKS_VERSION = 'books'
+
+
+def book_version_name(book_id):
+    return f'book:{book_id}'
+
+
+class LocMemLRUBackend:
+    """Кэш в памяти процесса: LRU на OrderedDict с TTL у каждой записи.
+    Версии хранятся отдельно и не вытесняются. Счетчик версий начинается
+    со случайного числа: версии разных процессов не совпадают, и ETag,
+    построенный по версии, не спутать с ETag другого процесса."""
+    # Не ходит по сети: можно вызывать прямо из async кода
+    blocking = False
+    # Версии видны только этому процессу: запись в другом процессе их не
+    # поднимет, поэтому ETag по ним строить нельзя
+    shared = False
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._counter = itertools.count(random.getrandbits(48))
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        expires_at = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_version(self, name):
+        with self._lock:
+            return self._versions.setdefault(name, next(self._counter))
+
+    def bump_version(self, name):
+        with self._lock:
+            self._versions[name] = next(self._counter)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoCacheBackend:
+    """Кэш через кэш-фреймворк Django (например, общий Redis/Memcached для
+    всех процессов). Версии лежат там же, без таймаута; потерянная версия
+    заводится заново со случайного числа, а не с 1, чтобы не повторить
+    старую."""
+    blocking = True
+    shared = True
+
+    def __init__(self, cache_alias='default', key_prefix='store-response'):
+        self.cache = caches[cache_alias]
+        self.key_prefix = key_prefix
+
+    def make_key(self, key):
+        return f'{self.key_prefix}:{key}'
+
+    def get(self, key):
+        return self.cache.get(self.make_key(key))
+
+    def set(self, key, value, timeout):
+        self.cache.set(self.make_key(key), value, timeout)
+
+    def get_version(self, name):
+        key = self.make_key(f'version:{name}')
+        version = self.cache.get(key)
+        if version is None:
+            self.cache.add(key, random.getrandbits(48), None)
+            version = self.cache.get(key)
+        return version
+
+    def bump_version(self, name):
+        key = self.make_key(f'version:{name}')
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.add(key, random.getrandbits(48), None)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class ResponseCache:
+    """Кэш отрендеренных ответов BookViewSet вместе с их ETag и
+    Last-Modified.
+
+    Ключ = маршрут + версия + нормализованная строка запроса. Запись
+    ничего не удаляет из кэша, а поднимает версию: старые ключи просто
+    перестают запрашиваться и вытесняются по LRU/TTL.
+    """
+
+    def __init__(self, backend, timeout=60, max_entry_size=1024 * 1024):
+        self.backend = backend
+        self.timeout = timeout
+        self.max_entry_size = max_entry_size
+
+    @staticmethod
+    def normalize_query(query_params):
+        # Имена и значения экранируются: иначе ?ordering=-price%26search%3Dx
+        # дал бы тот же ключ (и ETag), что ?ordering=-price&search=x
+        return urlencode(sorted(
+            (name, value)
+            for name in query_params
+            for value in query_params.getlist(name)
+        ))
+
+    def list_version(self):
+        """Версия всех списков книг: меняется при любой записи"""
+        return self.backend.get_version(BOOKS_VERSION)
+
+    def list_key(self, query_params):
+        version = self.list_version()
+        return f'book-list:{version}:{self.normalize_query(query_params)}'
+
+    def leaderboard_key(self, name, query_params):
+        # Лидерборд зависит от любых книг - версия та же, что у списка
+        version = self.list_version()
+        return f'book-{name}:{version}:{self.normalize_query(query_params)}'
+
+    def detail_key(self, book_id, query_params):
+        # '01' и 1 - одна книга: ключ и имя версии по числу, как в
+        # invalidate_books
+        book_id = int(book_id)
+        version = self.backend.get_version(book_version_name(book_id))
+        return f'book-detail:{book_id}:{version}:' \
+               f'{self.normalize_query(query_params)}'
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, entry):
+        """entry - (content, etag, last_modified), размер считается по
+        content"""
+        if len(entry[0]) > self.max_entry_size:
+            return
+        self.backend.set(key, entry, self.timeout)
+
+    def invalidate(self, book_ids=()):
+        self.backend.bump_version(BOOKS_VERSION)
+        for book_id in book_ids:
+            self.backend.bump_version(book_version_name(book_id))
+
+
+def set_validators(response, etag, timestamp):
+    """ETag и Last-Modified для ответов 200 и 304 (без ETag - ничего)"""
+    if etag is not None and response.status_code in (200, 304):
+        response['ETag'] = etag
+        if timestamp is not None:
+            response['Last-Modified'] = http_date(timestamp)
+    return response
+
+
+def entry_response(request, entry):
+    """Ответ по записи кэша (content, etag, timestamp): 304 для условного
+    запроса с совпавшими валидаторами, иначе сохраненный JSON. Запись без
+    ETag всегда отдается целиком"""
+    content, etag, timestamp = entry
+    response = None
+    if etag is not None:
+        response = get_conditional_response(
+            request, etag=etag, last_modified=timestamp
+        )
+    if response is None:
+        response = HttpResponse(content, content_type='application/json')
+    return set_validators(response, etag, timestamp)
+
+
+_response_cache = None
+
+
+def get_response_cache():
+    """ResponseCache по настройке BOOKS_RESPONSE_CACHE, None - кэш
+    выключен"""
+    global _response_cache
+    if _response_cache is None:
+        config = getattr(settings, 'BOOKS_RESPONSE_CACHE', None)
+        if not config or not config.get('BACKEND'):
+            return None
+        backend_class = import_string(config['BACKEND'])
+        _response_cache = ResponseCache(
+            backend_class(**config.get('OPTIONS', {})),
+            timeout=config.get('TIMEOUT', 60),
+            max_entry_size=config.get('MAX_ENTRY_SIZE', 1024 * 1024)
+        )
+    return _response_cache
+
+
+def invalidate_books(book_ids=()):
+    """Поднимает версию списка книг и переданных книг.
+
+    Версия поднимается сразу и еще раз после коммита: иначе параллельный
+    запрос мог бы между ними положить в кэш данные, прочитанные до коммита.
+    """
+    response_cache = get_response_cache()
+    if response_cache is None:
+        return
+    book_ids = list(book_ids)
+    response_cache.invalidate(book_ids)
+    transaction.on_commit(lambda: response_cache.invalidate(book_ids))
+
+
+@receiver(setting_changed)
+def reset_response_cache(setting, **kwargs):
+    global _response_cache
+    if setting == 'BOOKS_RESPONSE_CACHE':
+        _response_cache = None
@@ -1,10 +1,525 @@
-from django.db.models import Avg
+from collections import defaultdict
+from decimal import Decimal
 
-from store.models import UserBookRelation
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, Count, DecimalField, \
+    ExpressionWrapper, F, IntegerField, OuterRef, Q, Subquery, Sum, Value, \
+    When, Window
+from django.db.models.functions import Cast, Coalesce, NullIf, RowNumber, \
+    Now
+from django.utils import timezone
+
+from store.cache import invalidate_books
+from store.models import Book, BookSimilarity, UserBookRelation
+from store.recommendations import DEFAULT_TOP_K, capped_pairs_sql, \
+    record_like_changes
+
+
+def rating_expression(rating_sum, rating_count):
+    """rating = rating_sum / rating_count, NULL если оценок нет.
+
+    Округление до сотых половиной вверх в целых числах:
+    (sum * 200 + count) / (2 * count) сотых - то же, что compute_rating
+    в Python, без float и без округления драйвера или БД."""
+    cents = (rating_sum * 200 + rating_count) / \
+        NullIf(rating_count * 2, Value(0))
+    # Целые сотые умножаем, а не делим: деление целого на 100 в SQLite
+    # снова целочисленное
+    return Cast(
+        ExpressionWrapper(cents * Value(Decimal('0.01')),
+                          output_field=DecimalField()),
+        DecimalField(max_digits=3, decimal_places=2)
+    )
+
+
+def compute_rating(rating_sum, rating_count):
+    """rating_expression в Python"""
+    if not rating_count:
+        return None
+    return Decimal((rating_sum * 200 + rating_count) //
+                   (2 * rating_count)) / 100
+
+
+# Счетчики книги, которые меняет связь, в порядке relation_stats
+STATS_FIELDS = ('likes_count', 'rating_sum', 'rating_count') + \
+    Book.RATE_FIELDS
+
+
+def relation_stats(like, rate):
+    """Вклад связи в счетчики книги STATS_FIELDS. Изменение связи -
+    разность вкладов после и до"""
+    return (int(like), rate or 0, int(rate is not None)) + tuple(
+        int(rate == value) for value in range(1, len(Book.RATE_FIELDS) + 1)
+    )
+
+
+def rate_counts():
+    """Выражения полного пересчета rate_1, ..., rate_5 для aggregate
+    по UserBookRelation"""
+    return {
+        name: Count('pk', filter=Q(rate=value))
+        for value, name in enumerate(Book.RATE_FIELDS, start=1)
+    }
 
 
 def set_rating(book):
-    rating = UserBookRelation.objects.filter(book=book).aggregate(rating=Avg(
-        'rate')).get('rating')
-    book.rating = rating
-    book.save()
+    """Полный пересчет рейтинга книги по всем ее оценкам. На пути записи не
+    используется (там update_book_stats), нужен для сверки"""
+    stats = UserBookRelation.objects.filter(
+        book=book,
+        rate__isnull=False
+    ).aggregate(rating_sum=Sum('rate'), rating_count=Count('rate'),
+                **rate_counts())
+    book.rating_sum = stats['rating_sum'] or 0
+    book.rating_count = stats['rating_count']
+    book.rating = compute_rating(book.rating_sum, book.rating_count)
+    for name in Book.RATE_FIELDS:
+        setattr(book, name, stats[name])
+    # Только поля рейтинга: полный save перезаписал бы likes_count
+    # устаревшим значением из памяти
+    book.save(update_fields=['rating', 'rating_sum', 'rating_count',
+                             *Book.RATE_FIELDS, 'updated_at'])
+
+
+def update_book_stats(book_id, likes_delta=0, old_rate=None, new_rate=None):
+    """Применяет изменение одной связи к счетчикам книги одним
+    UPDATE ... F(): лайки, сумма и количество оценок, rating из них и
+    распределение оценок. updated_at сдвигается всегда - связь меняет и
+    список читателей"""
+    deltas = [new - old for new, old in zip(relation_stats(False, new_rate),
+                                            relation_stats(False, old_rate))]
+    deltas[0] = likes_delta
+
+    changes = {'updated_at': Now()}
+    for name, delta in zip(STATS_FIELDS, deltas):
+        if delta:
+            changes[name] = F(name) + delta
+    if 'rating_sum' in changes or 'rating_count' in changes:
+        changes['rating'] = rating_expression(
+            F('rating_sum') + deltas[1], F('rating_count') + deltas[2]
+        )
+    Book.objects.filter(pk=book_id).update(**changes)
+
+
+def bulk_update_book_stats(deltas):
+    """update_book_stats сразу для многих книг одним UPDATE с CASE по id.
+
+    deltas - {book_id: изменения счетчиков STATS_FIELDS (кортеж, см.
+    relation_stats)}. updated_at сдвигается у всех переданных книг, даже с
+    нулевыми изменениями"""
+    def delta(index):
+        return Case(
+            *(When(pk=book_id, then=Value(values[index]))
+              for book_id, values in deltas.items() if values[index]),
+            default=Value(0),
+            output_field=IntegerField()
+        )
+
+    changes = {'updated_at': Now()}
+    for index, name in enumerate(STATS_FIELDS):
+        if any(values[index] for values in deltas.values()):
+            changes[name] = F(name) + delta(index)
+    if 'rating_sum' in changes or 'rating_count' in changes:
+        changes['rating'] = rating_expression(
+            F('rating_sum') + delta(1), F('rating_count') + delta(2)
+        )
+    Book.objects.filter(pk__in=list(deltas)).update(**changes)
+
+
+def touch_user_books(user_id):
+    """Сдвигает updated_at и версию в кэше ответов у книг, в JSON которых
+    есть пользователь: владелец (owner_name) или читатель (readers).
+    Нужно при смене его имени и при удалении, иначе ETag книги не
+    изменится"""
+    book_ids = list(Book.objects.filter(
+        Q(owner_id=user_id) | Q(readers=user_id)
+    ).values_list('pk', flat=True).distinct())
+    if book_ids:
+        # Время из Python, а не Now(): CURRENT_TIMESTAMP в SQLite с точностью
+        # до секунды, и ETag мог бы не измениться
+        Book.objects.filter(pk__in=book_ids).update(
+            updated_at=timezone.now())
+        invalidate_books(book_ids)
+
+
+def reconcile_likes_count(books=None):
+    """Пересчитывает likes_count по UserBookRelation для книг, у которых
+    счетчик разошелся с реальным числом лайков. Возвращает число
+    исправленных книг."""
+    if books is None:
+        books = Book.objects.all()
+    likes = UserBookRelation.objects.filter(
+        book=OuterRef('pk'),
+        like=True
+    ).order_by().values('book').annotate(count=Count('pk')).values('count')
+    actual_likes = Coalesce(Subquery(likes), Value(0))
+    drifted = books.annotate(actual_likes=actual_likes).exclude(
+        likes_count=F('actual_likes')
+    ).values_list('pk', flat=True)
+    return Book.objects.filter(pk__in=list(drifted)).update(
+        likes_count=actual_likes
+    )
+
+
+def reconcile_rating(books=None):
+    """Пересчитывает rating_sum, rating_count, rating и rate_1, ..., rate_5
+    для книг, у которых они разошлись с оценками в UserBookRelation (или
+    rating - с rating_expression от них). Возвращает число исправленных
+    книг."""
+    if books is None:
+        books = Book.objects.all()
+    rates = UserBookRelation.objects.filter(
+        book=OuterRef('pk'),
+        rate__isnull=False
+    ).order_by().values('book')
+    actual_sum = Coalesce(
+        Subquery(rates.annotate(total=Sum('rate')).values('total')),
+        Value(0)
+    )
+    actual_count = Coalesce(
+        Subquery(rates.annotate(total=Count('rate')).values('total')),
+        Value(0)
+    )
+    actual_rates = {
+        name: Coalesce(
+            Subquery(rates.annotate(total=count).values('total')),
+            Value(0)
+        )
+        for name, count in rate_counts().items()
+    }
+    # NULL (нет оценок) сравнивается как -1: exclude с NULL не сработал бы
+    no_rating = Value(Decimal(-1))
+    drifted = books.annotate(
+        actual_sum=actual_sum,
+        actual_count=actual_count,
+        stored_rating=Coalesce('rating', no_rating),
+        actual_rating=Coalesce(
+            rating_expression(actual_sum, actual_count), no_rating
+        ),
+        **{f'actual_{name}': value for name, value in actual_rates.items()}
+    ).exclude(
+        rating_sum=F('actual_sum'),
+        rating_count=F('actual_count'),
+        stored_rating=F('actual_rating'),
+        **{name: F(f'actual_{name}') for name in actual_rates}
+    ).values_list('pk', flat=True)
+    return Book.objects.filter(pk__in=list(drifted)).update(
+        rating_sum=actual_sum,
+        rating_count=actual_count,
+        rating=rating_expression(actual_sum, actual_count),
+        **actual_rates
+    )
+
+
+def prefetch_readers_preview(books, limit):
+    """Вместо prefetch_related('readers') проставляет каждой книге
+    readers_preview - не более limit первых читателей - и readers_count.
+
+    Ограничение делает сама БД: ROW_NUMBER() OVER (PARTITION BY book) во
+    вложенном запросе и фильтр по нему снаружи, так что даже у книги с
+    миллионом читателей в Python приезжает только limit строк."""
+    books = list(books)
+    if not books:
+        return books
+    relations = UserBookRelation.objects.filter(
+        book_id__in=[book.id for book in books]
+    ).annotate(
+        reader_position=Window(
+            expression=RowNumber(),
+            partition_by=[F('book_id')],
+            order_by=F('id').asc()
+        ),
+        readers_total=Window(
+            expression=Count('id'),
+            partition_by=[F('book_id')]
+        )
+    ).order_by().values_list(
+        'book_id', 'user__first_name', 'user__last_name', 'reader_position',
+        'readers_total'
+    )
+    sql, params = relations.query.sql_with_params()
+
+    previews = {book.id: [] for book in books}
+    counts = {}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT * FROM ({sql}) preview '
+            f'WHERE preview.reader_position <= %s '
+            f'ORDER BY preview.book_id, preview.reader_position',
+            (*params, limit)
+        )
+        for book_id, first_name, last_name, _, total in cursor.fetchall():
+            previews[book_id].append({
+                'first_name': first_name,
+                'last_name': last_name
+            })
+            counts[book_id] = total
+
+    for book in books:
+        book.readers_preview = previews[book.id]
+        book.readers_count = counts.get(book.id, 0)
+    return books
+
+
+def attach_readers_values(rows, fields):
+    """Для строк .values() книг проставляет row['readers'] - список
+    словарей с полями fields читателей. Один запрос UserBookRelation JOIN
+    User только с нужными колонками, без экземпляров моделей."""
+    readers = defaultdict(list)
+    book_ids = [row['id'] for row in rows]
+    if book_ids:
+        relations = UserBookRelation.objects.filter(
+            book_id__in=book_ids
+        ).order_by('pk').values_list(
+            'book_id', *(f'user__{field}' for field in fields)
+        )
+        for book_id, *values in relations:
+            readers[book_id].append(dict(zip(fields, values)))
+    for row in rows:
+        row['readers'] = readers[row['id']]
+    return rows
+
+
+class RelationRaceError(Exception):
+    """Связь создали параллельно между чтением старых значений и вставкой"""
+
+
+def upsert_relation(user_id, book_id, changes, attempts=3):
+    """Создает или обновляет связь пользователь-книга одним
+    INSERT ... ON CONFLICT (user_id, book_id) DO UPDATE ... RETURNING и в той
+    же транзакции применяет изменения лайка и оценки к счетчикам книги.
+
+    changes - поля связи из запроса (like, in_bookmarks, rate), остальные
+    поля при обновлении не трогаются. Только PostgreSQL. Если книги нет -
+    Book.DoesNotExist."""
+    for _ in range(attempts):
+        try:
+            with transaction.atomic():
+                return _upsert_relation(user_id, book_id, changes)
+        except RelationRaceError:
+            continue
+    raise RelationRaceError
+
+
+def _upsert_relation(user_id, book_id, changes):
+    opts = UserBookRelation._meta
+    qn = connection.ops.quote_name
+    table = qn(opts.db_table)
+    book_table = qn(Book._meta.db_table)
+    similarities = qn(BookSimilarity._meta.db_table)
+    co_count = qn(BookSimilarity._meta.get_field('co_count').column)
+    like, in_bookmarks, rate = (
+        qn(opts.get_field(name).column)
+        for name in ('like', 'in_bookmarks', 'rate')
+    )
+    values = {'like': False, 'in_bookmarks': False, 'rate': None, **changes}
+    if changes:
+        assignments = ', '.join(
+            f'{qn(opts.get_field(name).column)} = '
+            f'EXCLUDED.{qn(opts.get_field(name).column)}'
+            for name in changes
+        )
+    else:
+        # Пустой PATCH: "обновление" без изменений, чтобы RETURNING вернул
+        # строку
+        assignments = f'{like} = {table}.{like}'
+
+    # old блокирует существующую строку (FOR UPDATE) и отдает значения до
+    # изменения. upsert читает из old (LEFT JOIN), поэтому old выполняется
+    # раньше вставки: иначе FOR UPDATE пропустил бы строку, уже измененную
+    # этим же запросом. EXISTS не дает вставить связь с несуществующей
+    # книгой (FK проверяется только при коммите); xmax = 0 означает, что
+    # строка вставлена, а не обновлена. similar_added/similar_removed
+    # поправляют co_count похожих книг (store.recommendations), если
+    # изменился лайк: пары с остальными лайками пользователя (liked - снимок
+    # до запроса, этой книги в нем нет). Новых пар - не больше, чем нужно до
+    # DEFAULT_TOP_K соседей у книги (capped_pairs_sql)
+    pairs = f'''
+        SELECT pair.book_id, pair.similar_id
+        FROM upsert LEFT JOIN old ON true
+        CROSS JOIN liked
+        CROSS JOIN LATERAL (VALUES (%s::bigint, liked.book_id),
+                                   (liked.book_id, %s::bigint))
+            AS pair (book_id, similar_id)
+        WHERE upsert.{like} AND NOT COALESCE(old.{like}, false)
+    '''
+    sql = f'''
+        WITH old AS (
+            SELECT {like}, {rate} FROM {table}
+            WHERE user_id = %s AND book_id = %s
+            FOR UPDATE
+        ), upsert AS (
+            INSERT INTO {table} (user_id, book_id, {like}, {in_bookmarks},
+                                 {rate})
+            SELECT %s, %s, %s, %s, %s
+            FROM (VALUES (1)) AS source LEFT JOIN old ON true
+            WHERE EXISTS (SELECT 1 FROM {book_table} WHERE id = %s)
+            ON CONFLICT (user_id, book_id) DO UPDATE SET {assignments}
+            RETURNING id, {like}, {in_bookmarks}, {rate}, xmax = 0
+        ), liked AS (
+            SELECT book_id FROM {table}
+            WHERE user_id = %s AND {like} AND book_id <> %s
+        ), similar_added AS (
+            INSERT INTO {similarities} (book_id, similar_id, {co_count})
+            SELECT book_id, similar_id, 1
+            FROM ({capped_pairs_sql(pairs)}) pair
+            ORDER BY 1, 2
+            ON CONFLICT (book_id, similar_id) DO UPDATE
+            SET {co_count} = {similarities}.{co_count} + 1
+        ), similar_removed AS (
+            UPDATE {similarities}
+            SET {co_count} = {similarities}.{co_count} - 1
+            FROM upsert JOIN old ON true
+            WHERE NOT upsert.{like} AND old.{like}
+              AND {similarities}.{co_count} > 0
+              AND ({similarities}.book_id = %s
+                   AND {similarities}.similar_id IN (SELECT * FROM liked)
+                   OR {similarities}.similar_id = %s
+                   AND {similarities}.book_id IN (SELECT * FROM liked))
+        )
+        SELECT upsert.*, old.{like}, old.{rate}
+        FROM upsert LEFT JOIN old ON true
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (
+            user_id, book_id,
+            user_id, book_id,
+            values['like'], values['in_bookmarks'], values['rate'],
+            book_id,
+            user_id, book_id,
+            book_id, book_id, DEFAULT_TOP_K,
+            book_id, book_id,
+        ))
+        row = cursor.fetchone()
+    if row is None:
+        raise Book.DoesNotExist
+    (relation_id, new_like, new_in_bookmarks, new_rate, inserted,
+     old_like, old_rate) = row
+
+    if inserted:
+        old_like, old_rate = False, None
+    elif old_like is None:
+        # Строки не было в снимке old, но вставка упала в конфликт: ее
+        # только что создала другая транзакция. Повторяем - теперь old ее
+        # увидит
+        raise RelationRaceError
+
+    if inserted or old_like != new_like or old_rate != new_rate:
+        update_book_stats(
+            book_id,
+            likes_delta=int(new_like) - int(old_like),
+            old_rate=old_rate,
+            new_rate=new_rate
+        )
+    invalidate_books([book_id])
+
+    return UserBookRelation.from_db(
+        connection.alias,
+        ['id', 'user_id', 'book_id', 'like', 'in_bookmarks', 'rate'],
+        [relation_id, user_id, book_id, new_like, new_in_bookmarks,
+         new_rate]
+    )
+
+
+# Пользователей в одном SELECT ... FOR UPDATE в _apply_relation_changes
+LOCK_USERS_CHUNK = 100
+
+
+def bulk_upsert_relations(user_id, items, attempts=3):
+    """Применяет пачку изменений связей пользователя с книгами (офлайн
+    синхронизация) в одной транзакции.
+
+    items - проверенные данные UserBooksRelationSerializer(many=True):
+    словари с book и любыми из like, in_bookmarks, rate. Несколько
+    изменений одной книги сливаются по порядку. Возвращает связи в порядке
+    книг."""
+    changes = {}
+    for item in items:
+        item = dict(item)
+        book = item.pop('book')
+        changes.setdefault((user_id, book.pk), {}).update(item)
+    relations = apply_relation_changes(changes, attempts)
+    return [relations[key] for key in changes]
+
+
+def apply_relation_changes(changes, attempts=3):
+    """Применяет изменения связей {(user_id, book_id): {поле: значение}}
+    в одной транзакции: новые связи вставляются одним bulk_create,
+    измененные - одним bulk_update, счетчики всех затронутых книг
+    (изменения всех пользователей суммируются) - одним UPDATE.
+    Возвращает {(user_id, book_id): связь}."""
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic():
+                return _apply_relation_changes(changes)
+        except IntegrityError:
+            # Какую-то из связей параллельно создали после SELECT FOR
+            # UPDATE - повторяем, теперь она будет среди существующих
+            if attempt == attempts - 1:
+                raise
+
+
+def _apply_relation_changes(changes):
+    # Блокируем существующие связи в одном порядке, чтобы параллельные
+    # пачки не взаимоблокировались. Условие - список книг на пользователя, и
+    # пользователи идут порциями: одно условие на пару (или на
+    # пользователя в большой пачке отложенной записи) упирается в предел
+    # глубины выражения SQLite (1000)
+    books_by_user = defaultdict(list)
+    for user_id, book_id in changes:
+        books_by_user[user_id].append(book_id)
+    users = sorted(books_by_user)
+    relations = {}
+    for start in range(0, len(users), LOCK_USERS_CHUNK):
+        pairs = Q(*(Q(user_id=user_id, book_id__in=books_by_user[user_id])
+                    for user_id in users[start:start + LOCK_USERS_CHUNK]),
+                  _connector=Q.OR)
+        relations.update(
+            ((relation.user_id, relation.book_id), relation)
+            for relation in UserBookRelation.objects.select_for_update(
+            ).filter(pairs).order_by('user_id', 'book_id')
+        )
+    created, updated, fields, deltas = [], [], set(), {}
+    # {user_id: (лайкнутые книги, книги со снятым лайком)}
+    like_changes = defaultdict(lambda: ([], []))
+    for (user_id, book_id), values in changes.items():
+        relation = relations.get((user_id, book_id))
+        if relation is None:
+            relation = UserBookRelation(user_id=user_id, book_id=book_id,
+                                        **values)
+            relations[user_id, book_id] = relation
+            created.append(relation)
+            old_like, old_rate = False, None
+        else:
+            old_like, old_rate = relation.like, relation.rate
+            for name, value in values.items():
+                setattr(relation, name, value)
+            dirty = relation.get_dirty_fields()
+            if not dirty:
+                continue
+            updated.append(relation)
+            fields.update(dirty)
+        if relation.like != old_like:
+            like_changes[user_id][0 if relation.like else 1].append(book_id)
+        deltas[book_id] = tuple(
+            current + new - old for current, new, old in zip(
+                deltas.get(book_id, (0,) * len(STATS_FIELDS)),
+                relation_stats(relation.like, relation.rate),
+                relation_stats(old_like, old_rate)
+            )
+        )
+
+    # bulk_create/bulk_update не вызывают save() и сигналы, счетчики книг
+    # меняются только здесь
+    if created:
+        UserBookRelation.objects.bulk_create(created)
+    if updated:
+        UserBookRelation.objects.bulk_update(updated, list(fields))
+        for relation in updated:
+            relation._snapshot()
+    if deltas:
+        bulk_update_book_stats(deltas)
+        invalidate_books(deltas)
+    for user_id, (added, removed) in like_changes.items():
+        record_like_changes(user_id, added, removed)
+    return relations
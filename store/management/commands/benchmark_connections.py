@@ -0,0 +1,57 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from books.db_backends.postgresql.base import DatabaseWrapper
+
+# Режимы: новое соединение на каждый запрос (как было), постоянное
+# соединение с проверкой и пул
+MODES = (
+    ('new connection', {'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False,
+                        'POOL': None}),
+    ('persistent + health checks', {'CONN_MAX_AGE': 60,
+                                    'CONN_HEALTH_CHECKS': True,
+                                    'POOL': None}),
+    ('pool', {'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': False,
+              'POOL': {'MAX_SIZE': 1, 'TIMEOUT': 10}}),
+)
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает задержку "HTTP запроса" с одним SELECT 1 к БД из ' \
+           'DATABASES["default"] (например, postgres из docker-compose) ' \
+           'для разных режимов соединений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            self.stderr.write('Only PostgreSQL is supported')
+            return
+        for name, overrides in MODES:
+            wrapper = DatabaseWrapper(
+                {**connection.settings_dict, **overrides},
+                alias='benchmark'
+            )
+            timings = []
+            try:
+                for _ in range(options['requests']):
+                    started = time.perf_counter()
+                    # Как сигналы request_started/request_finished
+                    wrapper.close_if_unusable_or_obsolete()
+                    with wrapper.cursor() as cursor:
+                        cursor.execute('SELECT 1')
+                        cursor.fetchall()
+                    wrapper.close_if_unusable_or_obsolete()
+                    timings.append((time.perf_counter() - started) * 1000)
+            finally:
+                wrapper.close()
+            timings.sort()
+            self.stdout.write(
+                f'{name:<28} mean {statistics.mean(timings):7.2f} ms  '
+                f'p50 {timings[len(timings) // 2]:7.2f} ms  '
+                f'p95 {timings[int(len(timings) * 0.95)]:7.2f} ms'
+            )
@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment
+
+from store.benchmarks import DEFAULT_PARAMS, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Прогоняет сценарии API на сгенерированных данных во временной ' \
+           'тестовой БД и печатает число запросов, время, память и размер ' \
+           'ответа по каждому сценарию'
+
+    def add_arguments(self, parser):
+        for name, value in DEFAULT_PARAMS.items():
+            parser.add_argument(f'--{name}', type=type(value), default=value)
+        parser.add_argument('--baseline',
+                            help='Записать результат в этот JSON файл '
+                                 '(например, store/tests/'
+                                 'benchmark_baseline.json)')
+
+    def handle(self, *args, **options):
+        params = {name: options[name] for name in DEFAULT_PARAMS}
+        setup_test_environment(debug=False)
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            results = run_benchmarks(params)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['baseline']:
+            with open(options['baseline'], 'w') as baseline:
+                baseline.write(output + '\n')
+        self.stdout.write(output)
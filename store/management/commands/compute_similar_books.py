@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from store.recommendations import DEFAULT_TOP_K, compute_similarities
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает похожие книги (BookSimilarity): для каждой книги ' \
+           'top-K книг, которые лайкали те же пользователи'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K)
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Книг (диапазон id) в одной транзакции')
+
+    def handle(self, *args, **options):
+        written = compute_similarities(top_k=options['top_k'],
+                                       batch_size=options['batch_size'])
+        self.stdout.write(f'similar books: wrote {written} pair(s)')
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Book
+from store.transfer import FORMATS, export_books
+
+
+class Command(BaseCommand):
+    help = 'Выгружает каталог книг (с rating и likes_count) в CSV или ' \
+           'NDJSON через серверный курсор'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-',
+                            help='Файл, по умолчанию stdout')
+        parser.add_argument('--output', choices=FORMATS, default='csv')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        target = self.stdout if path == '-' else \
+            open(path, 'w', encoding='utf-8', newline='')
+        try:
+            for line in export_books(Book.objects.all(), options['output'],
+                                     options['chunk_size']):
+                if target is self.stdout:
+                    target.write(line, ending='')
+                else:
+                    target.write(line)
+        finally:
+            if target is not self.stdout:
+                target.close()
@@ -0,0 +1,45 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from store.transfer import BookImportError, FORMATS, import_books
+
+
+class Command(BaseCommand):
+    help = 'Импортирует книги из CSV или NDJSON пачками bulk_create. ' \
+           'Колонки: name, price, author_name и необязательная owner ' \
+           '(username)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл или "-" для stdin')
+        parser.add_argument('--input', choices=FORMATS,
+                            help='Формат, по умолчанию по расширению файла')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--owner',
+                            help='username владельца для строк без owner')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['input'] or (
+            'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+        )
+        owner = None
+        if options['owner']:
+            try:
+                owner = User.objects.get(username=options['owner'])
+            except User.DoesNotExist:
+                raise CommandError(f'Unknown user "{options["owner"]}"')
+
+        source = sys.stdin if path == '-' else \
+            open(path, encoding='utf-8', newline='')
+        try:
+            created = import_books(source, input_format,
+                                   batch_size=options['batch_size'],
+                                   owner=owner)
+        except BookImportError as exc:
+            raise CommandError(str(exc))
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        self.stdout.write(f'Imported {created} book(s)')
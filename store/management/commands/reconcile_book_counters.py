@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from store.logic import reconcile_likes_count, reconcile_rating
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает денормализованные счетчики книг (likes_count, ' \
+           'rating_sum, rating_count, rating, rate_1..rate_5), если они ' \
+           'разошлись с UserBookRelation'
+
+    def handle(self, *args, **options):
+        fixed = reconcile_likes_count()
+        self.stdout.write(f'likes_count: fixed {fixed} book(s)')
+        fixed = reconcile_rating()
+        self.stdout.write(f'rating: fixed {fixed} book(s)')
@@ -0,0 +1,81 @@
+import bisect
+import threading
+from collections import defaultdict
+
+# Границы корзин гистограмм, миллисекунды. Последняя корзина - все, что
+# больше последней границы
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class Histogram:
+    """Гистограмма времени с фиксированными корзинами: память не растет с
+    числом запросов"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Верхняя граница корзины, в которую попадает квантиль q (None для
+        последней, неограниченной корзины)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': {
+                **{str(bound): count
+                   for bound, count in zip(self.buckets, self.counts)},
+                '+Inf': self.counts[-1],
+            },
+        }
+
+
+class MetricsRegistry:
+    """Гистограммы по маршруту и метрике в памяти процесса"""
+
+    def __init__(self):
+        self._histograms = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def observe(self, route, values):
+        """values - {имя метрики: значение}: время в мс или число
+        запросов"""
+        with self._lock:
+            histograms = self._histograms[route]
+            for name, value in values.items():
+                histograms.setdefault(name, Histogram()).observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                route: {name: histogram.as_dict()
+                        for name, histogram in histograms.items()}
+                for route, histograms in self._histograms.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,135 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from store.metrics import registry
+
+# Счетчики текущего HTTP запроса. ContextVar, а не
+# connection.execute_wrapper на время запроса: в async view запросы к БД
+# идут из других потоков (sync_to_async), а контекст копируется туда вместе
+# со ссылкой на счетчик
+_query_timer = ContextVar('query_timer', default=None)
+
+
+class QueryTimer:
+    """Число SQL запросов и их суммарное время, время сериализации"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.serialize_duration = 0.0
+        self.serializing = False
+
+
+@contextmanager
+def time_serialization():
+    """Засекает сериализацию (to_representation) для метрики serialize
+    текущего запроса. Вложенные вызовы не считаются повторно"""
+    timer = _query_timer.get()
+    if timer is None or timer.serializing:
+        yield
+        return
+    timer.serializing = True
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.serialize_duration += time.perf_counter() - started
+        timer.serializing = False
+
+
+def time_queries(execute, sql, params, many, context):
+    """execute_wrapper всех соединений (см. install_query_timer)"""
+    timer = _query_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.count += 1
+        timer.duration += time.perf_counter() - started
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """Обработчик connection_created: вешает time_queries на соединение"""
+    if time_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_queries)
+
+
+class PerformanceMiddleware:
+    """Замеряет запрос: число и время SQL запросов, время сериализации
+    (to_representation сериализаторов, см. time_serialization), время
+    рендеринга ответа (JSONRenderer: данные в байты JSON) и общее время.
+    Отдает их в заголовке
+    Server-Timing и складывает в гистограммы по имени маршрута
+    (book-list, book-detail, ...), см. store.metrics и /metrics/.
+
+    Замена debug_toolbar: дешево настолько, что работает и в production.
+    Работает и в sync, и в async цепочке middleware, чтобы не превращать
+    async view в sync.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Так Django (MiddlewareMixin) помечает middleware как async
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer, token, started = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_timer.reset(token)
+        return self.finish(request, response, timer, started)
+
+    async def __acall__(self, request):
+        timer, token, started = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_timer.reset(token)
+        return self.finish(request, response, timer, started)
+
+    def start(self, request):
+        request._render_duration = 0.0
+        timer = QueryTimer()
+        return timer, _query_timer.set(timer), time.perf_counter()
+
+    def finish(self, request, response, timer, started):
+        total = time.perf_counter() - started
+        values = {
+            'db': timer.duration * 1000,
+            'serialize': timer.serialize_duration * 1000,
+            'render': request._render_duration * 1000,
+            'total': total * 1000,
+        }
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={values["db"]:.2f};desc="{timer.count} queries"',
+            f'serialize;dur={values["serialize"]:.2f}',
+            f'render;dur={values["render"]:.2f}',
+            f'total;dur={values["total"]:.2f}',
+        ])
+
+        match = getattr(request, 'resolver_match', None)
+        if match is not None and match.url_name:
+            values['queries'] = timer.count
+            registry.observe(match.url_name, values)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF Response рендерится после view: засекаем время рендеринга
+        # (сериализаторы к этому моменту уже отработали во view)
+        started = time.perf_counter()
+
+        def rendered(response):
+            request._render_duration += time.perf_counter() - started
+
+        response.add_post_render_callback(rendered)
+        return response
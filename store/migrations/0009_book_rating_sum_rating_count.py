@@ -0,0 +1,51 @@
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, OuterRef, Subquery, Sum, \
+    Value
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+
+def fill_rating_totals(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    rates = UserBookRelation.objects.filter(
+        book=OuterRef('pk'),
+        rate__isnull=False
+    ).order_by().values('book')
+    rating_sum = Coalesce(
+        Subquery(rates.annotate(total=Sum('rate')).values('total')),
+        Value(0)
+    )
+    rating_count = Coalesce(
+        Subquery(rates.annotate(total=Count('rate')).values('total')),
+        Value(0)
+    )
+    Book.objects.update(
+        rating_sum=rating_sum,
+        rating_count=rating_count,
+        rating=Cast(
+            Cast(rating_sum, DecimalField(max_digits=12, decimal_places=2)) /
+            NullIf(rating_count, Value(0)),
+            DecimalField(max_digits=3, decimal_places=2)
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_book_likes_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_rating_totals, migrations.RunPython.noop),
+    ]
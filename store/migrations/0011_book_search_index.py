@@ -0,0 +1,64 @@
+from django.db import migrations
+
+POSTGRESQL_FORWARD = """
+ALTER TABLE store_book ADD COLUMN search_vector tsvector;
+
+CREATE FUNCTION store_book_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('simple', coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(NEW.author_name, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER store_book_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF name, author_name ON store_book
+    FOR EACH ROW EXECUTE FUNCTION store_book_search_vector_update();
+
+UPDATE store_book SET name = name;
+
+CREATE INDEX store_book_search_vector_idx
+    ON store_book USING gin (search_vector);
+"""
+
+POSTGRESQL_BACKWARD = """
+DROP TRIGGER store_book_search_vector_trigger ON store_book;
+DROP FUNCTION store_book_search_vector_update();
+ALTER TABLE store_book DROP COLUMN search_vector;
+"""
+
+SQLITE_FORWARD = """
+CREATE VIRTUAL TABLE store_book_search USING fts5(name, author_name);
+INSERT INTO store_book_search (rowid, name, author_name)
+    SELECT id, name, author_name FROM store_book;
+"""
+
+SQLITE_BACKWARD = """
+DROP TABLE store_book_search;
+"""
+
+
+def run_vendor_sql(postgresql, sqlite):
+    def run(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        if vendor == 'postgresql':
+            schema_editor.execute(postgresql)
+        elif vendor == 'sqlite':
+            for statement in sqlite.strip().split(';\n'):
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0010_book_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_vendor_sql(POSTGRESQL_FORWARD, SQLITE_FORWARD),
+            run_vendor_sql(POSTGRESQL_BACKWARD, SQLITE_BACKWARD),
+        ),
+    ]
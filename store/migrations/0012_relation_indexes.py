@@ -0,0 +1,53 @@
+# Generated by Django 4.0.1 on 2026-10-18 07:36
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def delete_duplicate_relations(apps, schema_editor):
+    # До уникального ограничения get_or_create под гонкой мог создать
+    # несколько связей на пару пользователь-книга. Оставляем самую раннюю;
+    # счетчики книг после этого пересчитывает
+    # manage.py reconcile_book_counters
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    duplicates = UserBookRelation.objects.values('user', 'book').annotate(
+        first_id=Min('id')
+    ).filter(first_id__lt=models.Max('id')).order_by()
+    for duplicate in duplicates:
+        UserBookRelation.objects.filter(
+            user=duplicate['user'],
+            book=duplicate['book'],
+            id__gt=duplicate['first_id']
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_book_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['price', 'id'], name='store_book_price_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['author_name', 'id'], name='store_book_author_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(condition=models.Q(('like', True)), fields=['book'], name='store_rel_book_like_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(condition=models.Q(('rate__isnull', False)), fields=['book', 'rate'], name='store_rel_book_rate_idx'),
+        ),
+        migrations.RunPython(delete_duplicate_relations,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='userbookrelation',
+            constraint=models.UniqueConstraint(fields=('user', 'book'), name='store_relation_user_book_uniq'),
+        ),
+    ]
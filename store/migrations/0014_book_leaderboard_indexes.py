@@ -0,0 +1,21 @@
+# Generated by Django 4.0.1 on 2026-10-18 07:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_relation_user_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(condition=models.Q(('rating__isnull', False)), fields=['-rating', 'id'], name='store_book_top_rated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(condition=models.Q(('likes_count__gt', 0)), fields=['-likes_count', 'id'], name='store_book_most_liked_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0.1 on 2026-10-18 08:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_book_leaderboard_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookSimilarity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('co_count', models.PositiveIntegerField(default=0)),
+                ('book', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='similarities', to='store.book')),
+                ('similar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_to', to='store.book')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='booksimilarity',
+            index=models.Index(fields=['book', '-co_count', 'similar'], name='store_similarity_top_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='booksimilarity',
+            constraint=models.UniqueConstraint(fields=('book', 'similar'), name='store_similarity_book_similar_uniq'),
+        ),
+    ]
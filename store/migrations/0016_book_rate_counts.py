@@ -0,0 +1,57 @@
+# Generated by Django 4.0.1 on 2026-10-18 08:05
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_rate_counts(apps, schema_editor):
+    # Распределение уже поставленных оценок - один UPDATE по всем книгам
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    changes = {}
+    for rate in range(1, 6):
+        counts = UserBookRelation.objects.filter(
+            book=OuterRef('pk'),
+            rate=rate
+        ).order_by().values('book').annotate(total=Count('pk'))
+        changes[f'rate_{rate}'] = Coalesce(
+            Subquery(counts.values('total')), Value(0)
+        )
+    Book.objects.update(**changes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0015_booksimilarity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rate_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rate_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rate_3',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rate_4',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rate_5',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_rate_counts, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,82 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.db.models import DEFERRED
 
 
-class Book(models.Model):
+class DirtyFieldsMixin:
+    """Отслеживает, какие поля модели изменились с момента загрузки.
+
+    Значения снимаются в from_db одним кортежем (в порядке
+    _meta.concrete_fields), так что лишнего SELECT перед save нет. save()
+    пишет только измененные поля через update_fields, а если ничего не
+    изменилось - не ходит в БД вообще.
+    """
+    # Кортеж значений на момент загрузки, None - объект не из БД
+    _loaded_values = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._snapshot(fields)
+
+    def _snapshot(self, update_fields=None):
+        fields = self._meta.concrete_fields
+        if update_fields is not None and self._loaded_values is not None:
+            # Сохранены не все поля - обновляем снимок только для них
+            values = list(self._loaded_values)
+            for index, field in enumerate(fields):
+                if field.name in update_fields or \
+                        field.attname in update_fields:
+                    values[index] = self.__dict__.get(field.attname,
+                                                      DEFERRED)
+            self._loaded_values = tuple(values)
+            return
+        self._loaded_values = tuple(
+            self.__dict__.get(field.attname, DEFERRED) for field in fields
+        )
+
+    def get_dirty_fields(self):
+        """Словарь {attname: значение при загрузке} для измененных полей.
+        None, если объект не загружен из БД и сравнить не с чем."""
+        if self._loaded_values is None:
+            return None
+        dirty = {}
+        for field, old_value in zip(self._meta.concrete_fields,
+                                    self._loaded_values):
+            if field.primary_key or old_value is DEFERRED or \
+                    field.attname not in self.__dict__:
+                continue
+            if self.__dict__[field.attname] != old_value:
+                dirty[field.attname] = old_value
+        return dirty
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if not self._state.adding and not args and update_fields is None \
+                and not kwargs.get('force_insert'):
+            dirty = self.get_dirty_fields()
+            if dirty is not None:
+                if not dirty:
+                    return
+                # auto_now поля (updated_at) проставляются в pre_save и
+                # тоже должны попасть в UPDATE
+                kwargs['update_fields'] = list(dirty) + [
+                    field.attname for field in self._meta.concrete_fields
+                    if getattr(field, 'auto_now', False)
+                ]
+        super().save(*args, **kwargs)
+        self._snapshot(kwargs.get('update_fields'))
+
+
+class Book(DirtyFieldsMixin, models.Model):
+    # Счетчики оценок по значению rate (UserBookRelation.RATE_CHOICES)
+    RATE_FIELDS = ('rate_1', 'rate_2', 'rate_3', 'rate_4', 'rate_5')
+
     name = models.CharField(max_length=255)
     price = models.DecimalField(max_digits=7, decimal_places=2)
     author_name = models.CharField(max_length=255)
@@ -23,12 +97,51 @@ class Book(models.Model):
     # аннотациях view.py
     rating = models.DecimalField(max_digits=3, decimal_places=2,
                                  default=None, null=True)
+    # Счетчик лайков хранится в книге и меняется через F() при изменении
+    # UserBookRelation.like, чтобы не считать Count по связям на каждом
+    # чтении списка
+    likes_count = models.PositiveIntegerField(default=0)
+    # Сумма и количество оценок: rating = rating_sum / rating_count
+    # пересчитывается на лету одним UPDATE при каждой новой оценке, без Avg
+    # по всем связям книги
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    # Распределение оценок: сколько раз книгу оценили на 1, ..., 5. Меняются
+    # вместе с rating_sum/rating_count тем же UPDATE
+    rate_1 = models.PositiveIntegerField(default=0)
+    rate_2 = models.PositiveIntegerField(default=0)
+    rate_3 = models.PositiveIntegerField(default=0)
+    rate_4 = models.PositiveIntegerField(default=0)
+    rate_5 = models.PositiveIntegerField(default=0)
+    # Время последнего изменения книги или ее связей (лайки, оценки,
+    # читатели) - для ETag/Last-Modified
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Сортировки BookViewSet (?ordering=price/author_name) вместе с
+            # тайбрейкером keyset пагинации
+            models.Index(fields=['price', 'id'],
+                         name='store_book_price_id_idx'),
+            models.Index(fields=['author_name', 'id'],
+                         name='store_book_author_id_idx'),
+            # Лидерборды /book/top_rated/ и /book/most_liked/: индекс и есть
+            # готовый рейтинг, top-k - чтение первых k записей. Счетчики
+            # меняются одним UPDATE, индекс обновляется вместе с ними.
+            # Книги без оценок и лайков в лидерборды не попадают
+            models.Index(fields=['-rating', 'id'],
+                         condition=models.Q(rating__isnull=False),
+                         name='store_book_top_rated_idx'),
+            models.Index(fields=['-likes_count', 'id'],
+                         condition=models.Q(likes_count__gt=0),
+                         name='store_book_most_liked_idx'),
+        ]
 
     def __str__(self):
         return f'Id {self.id}: {self.name}'
 
 
-class UserBookRelation(models.Model):
+class UserBookRelation(DirtyFieldsMixin, models.Model):
     RATE_CHOICES = (
         (1, 'Ok'),
         (2, 'Fine'),
@@ -42,22 +155,104 @@ class UserBookRelation(models.Model):
     in_bookmarks = models.BooleanField(default=False)
     rate = models.PositiveSmallIntegerField(choices=RATE_CHOICES, null=True)
 
+    class Meta:
+        constraints = [
+            # Одна связь на пару пользователь-книга (UserBooksRelationView
+            # ищет ее именно так)
+            models.UniqueConstraint(fields=['user', 'book'],
+                                    name='store_relation_user_book_uniq'),
+        ]
+        indexes = [
+            # Лайки книги: частичный индекс только по лайкнутым связям
+            models.Index(fields=['book'], condition=models.Q(like=True),
+                         name='store_rel_book_like_idx'),
+            # Оценки книги: Sum/Count(rate) читаются из индекса без таблицы
+            models.Index(fields=['book', 'rate'],
+                         condition=models.Q(rate__isnull=False),
+                         name='store_rel_book_rate_idx'),
+            # Ленты пользователя (/book_relation/liked/, bookmarked/,
+            # rated/): связи пользователя с флагом, новые первыми - range
+            # scan по индексу в порядке keyset пагинации
+            models.Index(fields=['user', 'id'],
+                         condition=models.Q(like=True),
+                         name='store_rel_user_like_idx'),
+            models.Index(fields=['user', 'id'],
+                         condition=models.Q(in_bookmarks=True),
+                         name='store_rel_user_bookmark_idx'),
+            models.Index(fields=['user', 'id'],
+                         condition=models.Q(rate__isnull=False),
+                         name='store_rel_user_rate_idx'),
+        ]
+
     def __str__(self):
         return f'{self.user.username}: {self.book.name}, RATE {self.rate}'
 
     # save - функция, которая вызывается каждый раз при создании и
     # обновлении модели
     def save(self, *args, **kwargs):
-        from store.logic import set_rating
+        from store.logic import set_rating, reconcile_likes_count, \
+            update_book_stats
+        from store.recommendations import record_like_changes
 
-        # Создается новое поле, если не было первичного ключа
-        creating = not self.pk
+        # Для новой связи "старые" значения - значения по умолчанию
+        if self._state.adding:
+            dirty = {'like': False, 'rate': None}
+        else:
+            dirty = self.get_dirty_fields()
+            update_fields = kwargs.get('update_fields')
+            if dirty is not None and update_fields is not None:
+                dirty = {name: value for name, value in dirty.items()
+                         if name in update_fields}
+            if dirty is not None and 'like' not in dirty and \
+                    'rate' not in dirty:
+                # Счетчики книги не затронуты, транзакция не нужна
+                return super().save(*args, **kwargs)
 
-        old_rating = self.rate
-        super().save(*args, **kwargs)
-        new_rating = self.rate
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if dirty is None:
+                # Не знаем, что было до изменения - пересчитываем целиком
+                set_rating(self.book)
+                reconcile_likes_count(Book.objects.filter(pk=self.book_id))
+                update_book_stats(self.book_id)
+            else:
+                old_like = dirty.get('like', self.like)
+                update_book_stats(
+                    self.book_id,
+                    likes_delta=int(self.like) - int(old_like),
+                    old_rate=dirty.get('rate', self.rate),
+                    new_rate=self.rate
+                )
+                if old_like != self.like:
+                    record_like_changes(
+                        self.user_id,
+                        added=[self.book_id] if self.like else [],
+                        removed=[] if self.like else [self.book_id]
+                    )
 
-        # Если рейтинг изменился после изменения модели или идет создание
-        # нового поля модели
-        if old_rating != new_rating or creating:
-            set_rating(self.book)
+
+class BookSimilarity(models.Model):
+    """Сколько пользователей лайкнули обе книги (co_count). Для каждой книги
+    хранятся ее top-K соседей (manage.py compute_similar_books); новые лайки
+    поправляют эти пары и добавляют новые, только пока у книги меньше K
+    соседей (store.recommendations)"""
+    # Индекс по book не нужен: его покрывает уникальное ограничение
+    book = models.ForeignKey(Book, on_delete=models.CASCADE,
+                             related_name='similarities', db_index=False)
+    similar = models.ForeignKey(Book, on_delete=models.CASCADE,
+                                related_name='similar_to')
+    co_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'similar'],
+                                    name='store_similarity_book_similar_uniq'),
+        ]
+        indexes = [
+            # /book/{id}/similar/: первые записи индекса - ответ
+            models.Index(fields=['book', '-co_count', 'similar'],
+                         name='store_similarity_top_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.book_id} ~ {self.similar_id}: {self.co_count}'
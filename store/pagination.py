@@ -0,0 +1,211 @@
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Keyset (cursor) пагинация.
+
+    Вместо OFFSET следующая страница выбирается условием
+    (price, id) > (последняя цена, последний id), поэтому каждая страница -
+    это range scan по индексу, а не пропуск всех предыдущих строк.
+    Тайбрейкер идет в направлении первого ключа (-price, -id), чтобы
+    сортировка совпадала с индексом (price, id), прочитанным в обратную
+    сторону. Курсор непрозрачный: base64 от json с позицией и
+    направлением.
+    """
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    # Сортировка по умолчанию, если ее не задали ни OrderingFilter, ни
+    # queryset. Уникальное поле-"тайбрейкер" добавляется в конец всегда,
+    # чтобы позиция строки была однозначной
+    ordering = ('id',)
+    tiebreaker = 'id'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        position, reverse = self.decode_cursor(request)
+
+        # Для "предыдущей" страницы идем по индексу в обратную сторону
+        ordering = self.reverse_ordering(self.ordering) if reverse \
+            else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            try:
+                queryset = queryset.filter(
+                    self.keyset_filter(ordering, position)
+                )
+            except (TypeError, ValueError, ValidationError):
+                # Значение позиции не подходит к типу поля
+                raise NotFound(self.invalid_cursor_message)
+
+        # Берем на одну запись больше, чтобы узнать, есть ли еще страница
+        results = list(queryset[:self.page_size + 1])
+        has_following = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        if reverse:
+            self.has_next = position is not None
+            self.has_previous = has_following
+        else:
+            self.has_next = has_following
+            self.has_previous = position is not None
+
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'previous': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                return _positive_int(
+                    request.query_params[self.page_size_query_param],
+                    strict=True,
+                    cutoff=self.max_page_size
+                )
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def get_ordering(self, request, queryset, view):
+        """Сортировка страницы: из OrderingFilter (?ordering=-price), иначе
+        из queryset.order_by(), иначе self.ordering. В конец всегда
+        дописывается tiebreaker в направлении первого ключа."""
+        ordering = None
+        filter_backends = getattr(view, 'filter_backends', [])
+        for backend in filter_backends:
+            if issubclass(backend, OrderingFilter):
+                ordering = backend().get_ordering(request, queryset, view)
+                break
+        if not ordering:
+            ordering = list(queryset.query.order_by) or list(self.ordering)
+
+        ordering = [field for field in ordering if isinstance(field, str)]
+        if self.tiebreaker not in [field.lstrip('-') for field in ordering]:
+            descending = bool(ordering) and ordering[0].startswith('-')
+            ordering.append(('-' if descending else '') + self.tiebreaker)
+        return tuple(ordering)
+
+    @staticmethod
+    def reverse_ordering(ordering):
+        return tuple(
+            field[1:] if field.startswith('-') else '-' + field
+            for field in ordering
+        )
+
+    @staticmethod
+    def keyset_filter(ordering, position):
+        """Строит условие "строго после position" для составного ключа:
+        a >= x AND ((a > x) OR (a = x AND b > y) OR ...).
+
+        OR по ключам PostgreSQL проверяет только как Filter; избыточная
+        граница a >= x попадает в Index Cond, и страница начинается с
+        поиска по индексу, а не с отбрасывания всех предыдущих строк."""
+        condition = Q()
+        equal = Q()
+        for field, value in zip(ordering, position):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        first = ordering[0]
+        bound = 'lte' if first.startswith('-') else 'gte'
+        return Q(**{f'{first.lstrip("-")}__{bound}': position[0]}) & \
+            condition
+
+    def get_position(self, item):
+        names = [field.lstrip('-') for field in self.ordering]
+        if isinstance(item, dict):
+            return [item[name] for name in names]
+        return [getattr(item, name) for name in names]
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            cursor = json.loads(b64decode(encoded.encode('ascii')))
+            position = cursor['p']
+            reverse = bool(cursor.get('r'))
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        # Курсор от другой сортировки не подходит к текущему запросу
+        if cursor.get('o') != list(self.ordering) or \
+                not isinstance(position, list) or \
+                len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        # Значения ключей в курсоре - числа и строки (Decimal и даты
+        # DjangoJSONEncoder пишет строками)
+        if not all(isinstance(value, (int, float, str)) and
+                   not isinstance(value, bool) for value in position):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_cursor(self, position, reverse):
+        cursor = {'o': list(self.ordering), 'p': position}
+        if reverse:
+            cursor['r'] = 1
+        encoded = b64encode(
+            json.dumps(cursor, cls=DjangoJSONEncoder).encode('utf-8')
+        ).decode('ascii')
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, encoded
+        )
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.get_position(self.page[-1]), False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.get_position(self.page[0]), True)
+
+
+class RelationKeysetPagination(KeysetPagination):
+    """Keyset пагинация лент пользователя (понравившиеся, закладки,
+    оценки): новые связи первыми, позиция - id связи (relation_id), поэтому
+    страница - range scan по частичному индексу (user, id)"""
+    ordering = ('-relation_id',)
+    tiebreaker = 'relation_id'
@@ -0,0 +1,225 @@
+from django.db import connection, transaction
+from django.db.models import Count, F, Max, Q
+
+from store.models import Book, BookSimilarity, UserBookRelation
+
+# "Те, кому понравилась эта книга, лайкали и ...": co-occurrence лайков.
+#
+# BookSimilarity(book, similar, co_count) - сколько пользователей лайкнули
+# обе книги. compute_similarities полностью пересчитывает таблицу и
+# оставляет top-K соседей каждой книги; record_like_changes на каждом
+# изменении лайка поправляет co_count уже записанных пар, не дожидаясь
+# пересчета. Новую пару он добавляет, только пока у книги меньше
+# DEFAULT_TOP_K соседей: таблица между пересчетами не растет больше чем до
+# K строк на книгу, остальные пары появятся при следующем пересчете.
+
+# Соседей книги после пересчета
+DEFAULT_TOP_K = 20
+
+
+def compute_similarities(top_k=DEFAULT_TOP_K, batch_size=1000):
+    """Пересчитывает BookSimilarity: для книг пачками по batch_size id один
+    INSERT ... SELECT с самосоединением лайков по пользователю, GROUP BY
+    пары и row_number() для top_k соседей. Разреженная матрица
+    co-occurrence считается в БД и целиком в память не попадает. Каждая
+    пачка - своя транзакция; пару, которую между DELETE и INSERT успел
+    вставить record_like_changes, INSERT перезаписывает. Возвращает число
+    записанных пар."""
+    qn = connection.ops.quote_name
+    relations = qn(UserBookRelation._meta.db_table)
+    similarities = qn(BookSimilarity._meta.db_table)
+    co_count = qn(BookSimilarity._meta.get_field('co_count').column)
+    user, book, like = (
+        qn(UserBookRelation._meta.get_field(name).column)
+        for name in ('user', 'book', 'like')
+    )
+    insert = f'''
+        INSERT INTO {similarities} (book_id, similar_id, co_count)
+        SELECT book_id, similar_id, co_count FROM (
+            SELECT a.{book} AS book_id, b.{book} AS similar_id,
+                   COUNT(*) AS co_count,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY a.{book}
+                       ORDER BY COUNT(*) DESC, b.{book}
+                   ) AS position
+            FROM {relations} a
+            JOIN {relations} b
+              ON b.{user} = a.{user} AND b.{like} AND b.{book} <> a.{book}
+            WHERE a.{like} AND a.{book} >= %s AND a.{book} < %s
+            GROUP BY a.{book}, b.{book}
+        ) ranked
+        WHERE position <= %s
+        ON CONFLICT (book_id, similar_id) DO UPDATE
+        SET {co_count} = EXCLUDED.{co_count}
+    '''
+    last_id = Book.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    written = 0
+    for start in range(0, last_id + 1, batch_size):
+        end = start + batch_size
+        with transaction.atomic():
+            BookSimilarity.objects.filter(book_id__gte=start,
+                                          book_id__lt=end).delete()
+            with connection.cursor() as cursor:
+                cursor.execute(insert, [start, end, top_k])
+                written += cursor.rowcount
+    return written
+
+
+def capped_pairs_sql(pairs):
+    """Оставляет из пар SQL запроса pairs (колонки book_id, similar_id)
+    уже записанные и столько новых, чтобы у книги было не больше top_k
+    соседей. top_k - последний параметр (%s) после параметров pairs.
+    Новые пары одной книги нумеруются: COUNT(*) в одном запросе не видит
+    строк, которые этот же запрос вставляет"""
+    similarities = connection.ops.quote_name(BookSimilarity._meta.db_table)
+    return f'''
+        SELECT book_id, similar_id FROM (
+            SELECT book_id, similar_id, known, ROW_NUMBER() OVER (
+                PARTITION BY book_id, known ORDER BY similar_id
+            ) AS position
+            FROM (
+                SELECT pair.book_id, pair.similar_id, EXISTS (
+                    SELECT 1 FROM {similarities} s
+                    WHERE s.book_id = pair.book_id
+                      AND s.similar_id = pair.similar_id
+                ) AS known
+                FROM ({pairs}) pair
+            ) pairs
+        ) ranked
+        WHERE known OR position + (
+            SELECT COUNT(*) FROM {similarities} s
+            WHERE s.book_id = ranked.book_id
+        ) <= %s
+    '''
+
+
+def record_like_changes(user_id, added=(), removed=(), top_k=DEFAULT_TOP_K):
+    """Поправляет co_count после того, как пользователь лайкнул книги added
+    и снял лайк с книг removed (связи уже записаны). Один запрос.
+
+    +1 получают упорядоченные пары лайков пользователя, где есть книга из
+    added (INSERT ... SELECT ... ON CONFLICT): существующие всегда, новые -
+    пока у книги меньше top_k соседей. -1 - пары его лайков до изменения с
+    книгой из removed (UPDATE в CTE). Эти пары не пересекаются: в первых
+    обе книги сейчас лайкнуты, во вторых одна - нет."""
+    added, removed = list(added), list(removed)
+    if not added and not removed:
+        return
+    if connection.vendor != 'postgresql':
+        # UPDATE в CTE есть только в PostgreSQL
+        return _record_like_changes_orm(user_id, added, removed, top_k)
+    qn = connection.ops.quote_name
+    relations = qn(UserBookRelation._meta.db_table)
+    similarities = qn(BookSimilarity._meta.db_table)
+    co_count = qn(BookSimilarity._meta.get_field('co_count').column)
+    user, book, like = (
+        qn(UserBookRelation._meta.get_field(name).column)
+        for name in ('user', 'book', 'like')
+    )
+
+    def placeholders(values):
+        return ', '.join(['%s'] * len(values))
+
+    parts, params = [], []
+    if removed:
+        # Лайки до изменения: текущие без added и вместе с removed
+        kept = f'SELECT {book} FROM {relations} ' \
+               f'WHERE {user} = %s AND {like}'
+        params.append(user_id)
+        if added:
+            kept += f' AND {book} NOT IN ({placeholders(added)})'
+            params.extend(added)
+        removed_in = f'IN ({placeholders(removed)})'
+        update = f'''
+            UPDATE {similarities}
+            SET {co_count} = {co_count} - 1
+            WHERE {co_count} > 0
+              AND (book_id {removed_in}
+                   AND (similar_id IN (SELECT * FROM kept)
+                        OR similar_id {removed_in})
+                   OR similar_id {removed_in}
+                   AND book_id IN (SELECT * FROM kept))
+        '''
+        params.extend(removed * 3)
+        if not added:
+            parts.append(f'WITH kept AS ({kept}) {update}')
+        else:
+            parts.append(f'WITH kept AS ({kept}), '
+                         f'removed AS ({update})')
+    if added:
+        added_in = f'IN ({placeholders(added)})'
+        # ORDER BY - один порядок блокировок у параллельных вставок
+        pairs = f'''
+            SELECT a.{book} AS book_id, b.{book} AS similar_id
+            FROM {relations} a
+            JOIN {relations} b
+              ON b.{user} = a.{user} AND b.{like} AND b.{book} <> a.{book}
+            WHERE a.{user} = %s AND a.{like}
+              AND (a.{book} {added_in} OR b.{book} {added_in})
+        '''
+        parts.append(f'''
+            INSERT INTO {similarities} (book_id, similar_id, {co_count})
+            SELECT book_id, similar_id, 1
+            FROM ({capped_pairs_sql(pairs)}) pair
+            ORDER BY 1, 2
+            ON CONFLICT (book_id, similar_id) DO UPDATE
+            SET {co_count} = {similarities}.{co_count} + 1
+        ''')
+        params.extend([user_id, *added, *added, top_k])
+    with connection.cursor() as cursor:
+        cursor.execute(' '.join(parts), params)
+
+
+def _record_like_changes_orm(user_id, added, removed, top_k):
+    """record_like_changes через ORM (SQLite в тестах и локально). Пары
+    выбираются фильтрами по спискам книг (book_id__in/similar_id__in), а не
+    по одному условию на пару: у пользователя могут быть сотни лайков"""
+    added, removed = set(map(int, added)), set(map(int, removed))
+    liked = set(UserBookRelation.objects.filter(
+        user_id=user_id, like=True
+    ).values_list('book_id', flat=True))
+    kept = liked - added
+    before = kept | removed
+
+    if removed and len(before) > 1:
+        # Пары лайков до изменения с книгой из removed
+        BookSimilarity.objects.filter(
+            Q(book_id__in=removed, similar_id__in=before) |
+            Q(book_id__in=kept, similar_id__in=removed),
+            co_count__gt=0
+        ).update(co_count=F('co_count') - 1)
+    candidates = {(book, similar) for book in liked for similar in liked
+                  if book != similar and (book in added or similar in added)}
+    if not candidates:
+        return
+    pairs = BookSimilarity.objects.filter(
+        Q(book_id__in=added, similar_id__in=liked) |
+        Q(book_id__in=liked, similar_id__in=added)
+    )
+    existing = set(pairs.values_list('book_id', 'similar_id'))
+    if existing:
+        pairs.update(co_count=F('co_count') + 1)
+    missing = sorted(candidates - existing)
+    if not missing:
+        return
+    neighbours = dict(BookSimilarity.objects.filter(
+        book_id__in={book for book, _ in missing}
+    ).values_list('book_id').annotate(Count('id')).order_by())
+    created = []
+    for book, similar in missing:
+        if neighbours.get(book, 0) < top_k:
+            neighbours[book] = neighbours.get(book, 0) + 1
+            created.append(BookSimilarity(book_id=book, similar_id=similar,
+                                          co_count=1))
+    BookSimilarity.objects.bulk_create(created)
+
+
+def similar_books(book_id, fields):
+    """Соседи книги по убыванию co_count: .values(*fields) книг одним
+    запросом по индексу store_similarity_top_idx"""
+    return Book.objects.filter(
+        similar_to__book_id=book_id,
+        similar_to__co_count__gt=0
+    ).annotate(
+        co_count=F('similar_to__co_count')
+    ).order_by('-co_count', 'id').values(*fields, 'co_count')
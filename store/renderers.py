@@ -0,0 +1,34 @@
+from itertools import islice
+
+from rest_framework.renderers import JSONRenderer
+
+
+def chunked(iterable, size):
+    """Разбивает итератор на списки по size элементов"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class StreamingJSONRenderer(JSONRenderer):
+    """JSONRenderer, который отдает JSON массив по частям: в памяти
+    одновременно только одна пачка объектов, а первые байты уходят клиенту
+    до того, как сериализован весь список"""
+
+    def render_chunks(self, chunks):
+        """chunks - итератор списков уже сериализованных объектов, результат
+        - итератор bytes одного JSON массива"""
+        yield b'['
+        first = True
+        for chunk in chunks:
+            if not chunk:
+                continue
+            # Пачка рендерится обычным JSONRenderer (компактно, без
+            # пробелов), от нее отрезаются скобки массива
+            body = self.render(chunk)[1:-1]
+            yield body if first else b',' + body
+            first = False
+        yield b']'
@@ -0,0 +1,134 @@
+import re
+
+from django.db import connections
+from django.db.models import BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+from rest_framework.filters import SearchFilter
+
+# Полнотекстовый индекс книги строится по name (вес A) и author_name (вес
+# B) с конфигурацией 'simple': без стемминга, подходит и для русских, и для
+# английских названий.
+#
+# PostgreSQL: колонка store_book.search_vector (tsvector), которую
+# заполняет триггер, и GIN индекс по ней (миграция 0011). Django про колонку
+# не знает, поэтому в обычные SELECT она не попадает.
+#
+# SQLite: теневая FTS5 таблица store_book_search (rowid = id книги). Ее
+# обновляют сигналы моделей, а не триггеры: при изменении схемы SQLite
+# пересоздает store_book, и триггеры на ней пропали бы.
+SEARCH_TABLE = 'store_book_search'
+SEARCH_CONFIG = 'simple'
+
+# Термин поиска - последовательность букв/цифр; остальное - разделители
+TERM_RE = re.compile(r'\w+')
+
+
+def search_supported(using):
+    vendor = connections[using].vendor
+    if vendor == 'postgresql':
+        return True
+    if vendor == 'sqlite':
+        return SEARCH_TABLE in connections[using].introspection.table_names()
+    return False
+
+
+def update_search_index(books, using='default'):
+    """Переиндексирует книги в FTS5 таблице (только SQLite)"""
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or not search_supported(using):
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT OR REPLACE INTO {SEARCH_TABLE} '
+            f'(rowid, name, author_name) VALUES (%s, %s, %s)',
+            [(book.id, book.name, book.author_name) for book in books]
+        )
+
+
+def delete_from_search_index(book_ids, using='default'):
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or not search_supported(using):
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s',
+            [(book_id,) for book_id in book_ids]
+        )
+
+
+class BookSearchFilter(SearchFilter):
+    """Поиск ?search= по индексу вместо UPPER(name) LIKE '%...%'.
+
+    Каждый термин ищется как префикс слова в name или author_name, все
+    термины должны найтись. Результаты сортируются по релевантности
+    (search_rank), если клиент не задал ?ordering. На СУБД без индекса -
+    обычный SearchFilter с icontains.
+    """
+    rank_annotation = 'search_rank'
+
+    def get_index_terms(self, request):
+        return [
+            word
+            for term in self.get_search_terms(request)
+            for word in TERM_RE.findall(term)
+        ]
+
+    def filter_queryset(self, request, queryset, view):
+        if not self.get_search_terms(request):
+            return queryset
+        if not search_supported(queryset.db):
+            return super().filter_queryset(request, queryset, view)
+
+        terms = self.get_index_terms(request)
+        if not terms:
+            return queryset.none()
+        if connections[queryset.db].vendor == 'postgresql':
+            match, rank = self.postgresql_expressions(terms)
+        else:
+            match, rank = self.sqlite_expressions(terms)
+        return queryset.filter(match).annotate(
+            **{self.rank_annotation: rank}
+        ).order_by(f'-{self.rank_annotation}', 'id')
+
+    @staticmethod
+    def postgresql_expressions(terms):
+        # 'слово':* - префиксный поиск, кавычки внутри удваиваются
+        query = ' & '.join(
+            "'{}':*".format(term.replace("'", "''")) for term in terms
+        )
+        match = RawSQL(
+            f'"store_book"."search_vector" @@ '
+            f'to_tsquery(%s::regconfig, %s)',
+            (SEARCH_CONFIG, query),
+            output_field=BooleanField()
+        )
+        # float8, чтобы значение ранга без потерь проходило через курсор
+        # пагинации
+        rank = RawSQL(
+            f'ts_rank("store_book"."search_vector", '
+            f'to_tsquery(%s::regconfig, %s))::double precision',
+            (SEARCH_CONFIG, query),
+            output_field=FloatField()
+        )
+        return match, rank
+
+    @staticmethod
+    def sqlite_expressions(terms):
+        query = ' AND '.join(
+            '"{}"*'.format(term.replace('"', '""')) for term in terms
+        )
+        match = RawSQL(
+            f'"store_book"."id" IN (SELECT rowid FROM {SEARCH_TABLE} '
+            f'WHERE {SEARCH_TABLE} MATCH %s)',
+            (query,),
+            output_field=BooleanField()
+        )
+        # bm25 тем меньше, чем документ релевантнее
+        rank = RawSQL(
+            f'(SELECT -bm25({SEARCH_TABLE}, 2.0, 1.0) FROM {SEARCH_TABLE} '
+            f'WHERE {SEARCH_TABLE} MATCH %s '
+            f'AND rowid = "store_book"."id")',
+            (query,),
+            output_field=FloatField()
+        )
+        return match, rank
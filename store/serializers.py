@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
 
+from store.middleware import time_serialization
 from store.models import Book, UserBookRelation
 
 
@@ -11,9 +12,68 @@ class BookReaderSerializer(ModelSerializer):
         fields = ('first_name', 'last_name')
 
 
-class BookSerializer(ModelSerializer):
+class TimedRepresentationMixin:
+    """to_representation идет в метрику serialize запроса (см.
+    store.middleware.PerformanceMiddleware)"""
+
+    def to_representation(self, instance):
+        with time_serialization():
+            return super().to_representation(instance)
+
+
+class ExpandableFieldsMixin:
+    """Поля из Meta.expandable_fields выводятся, только если клиент их
+    запросил: имя есть в context['expand'] (?expand=имя,...) или явно
+    перечислено в context['fields']"""
+
+    def get_fields(self):
+        fields = super().get_fields()
+        expand = self.context.get('expand', ())
+        only = self.context.get('fields') or ()
+        for name in getattr(self.Meta, 'expandable_fields', ()):
+            if name not in expand and name not in only:
+                fields.pop(name, None)
+        return fields
+
+
+class SparseFieldsMixin:
+    """Если задан context['fields'] (frozenset имен, ?fields=имя,...),
+    выводятся только эти поля"""
+
+    def get_fields(self):
+        fields = super().get_fields()
+        only = self.context.get('fields')
+        if only is not None:
+            for name in list(fields):
+                if name not in only:
+                    del fields[name]
+        return fields
+
+
+class RatingHistogramField(serializers.Field):
+    """Распределение оценок книги [оценок 1, ..., оценок 5] из счетчиков
+    Book.rate_1, ..., rate_5: без запросов к UserBookRelation"""
+    # Колонки для строк .values() (store.compiled)
+    value_sources = Book.RATE_FIELDS
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, book):
+        return [getattr(book, name) for name in self.value_sources]
+
+
+class BookSerializer(TimedRepresentationMixin, SparseFieldsMixin,
+                     ExpandableFieldsMixin, ModelSerializer):
     # likes_count = serializers.SerializerMethodField()
-    annotated_likes = serializers.IntegerField(read_only=True)
+    # Имя поля оставлено прежним для клиентов, значение берется из
+    # денормализованного счетчика
+    annotated_likes = serializers.IntegerField(
+        source='likes_count',
+        read_only=True
+    )
     rating = serializers.DecimalField(
         max_digits=3,
         decimal_places=2,
@@ -25,6 +85,7 @@ class BookSerializer(ModelSerializer):
         read_only=True
     )
     readers = BookReaderSerializer(many=True, read_only=True)
+    rating_histogram = RatingHistogramField()
 
     class Meta:
         model = Book
@@ -36,8 +97,11 @@ class BookSerializer(ModelSerializer):
             'annotated_likes',
             'rating',
             'owner_name',
-            'readers'
+            'readers',
+            'rating_histogram'
         )
+        # Только по ?expand=
+        expandable_fields = ('rating_histogram',)
 
     # def get_likes_count(self, instance):
     #     return UserBookRelation.objects.filter(
@@ -46,7 +110,63 @@ class BookSerializer(ModelSerializer):
     #     ).count()
 
 
-class UserBooksRelationSerializer(ModelSerializer):
+class BookPreviewSerializer(BookSerializer):
+    """BookSerializer для режима ?readers_limit=N: вместо всех читателей
+    только первые N (см. logic.prefetch_readers_preview) и их общее
+    количество"""
+    readers = BookReaderSerializer(
+        source='readers_preview',
+        many=True,
+        read_only=True
+    )
+    readers_count = serializers.IntegerField(read_only=True)
+
+    class Meta(BookSerializer.Meta):
+        fields = BookSerializer.Meta.fields + ('readers_count',)
+
+
+class BookSummarySerializer(BookSerializer):
+    """Поля BookSerializer без читателей: для лидербордов и лент, где
+    список читателей не нужен"""
+
+    class Meta(BookSerializer.Meta):
+        fields = tuple(
+            name for name in BookSerializer.Meta.fields if name != 'readers'
+        )
+
+
+class BookFeedSerializer(BookSummarySerializer):
+    """Книга в ленте пользователя (понравившиеся, закладки, оценки) и связь
+    этого пользователя с книгой"""
+    like = serializers.BooleanField(read_only=True)
+    in_bookmarks = serializers.BooleanField(read_only=True)
+    rate = serializers.IntegerField(read_only=True)
+
+    class Meta(BookSummarySerializer.Meta):
+        fields = BookSummarySerializer.Meta.fields + (
+            'like', 'in_bookmarks', 'rate'
+        )
+
+
+class BookPrimaryKeyField(serializers.PrimaryKeyRelatedField):
+    """Книга по id. Если в context['books'] заранее загружены книги
+    ({id: Book}), берет их оттуда, а не делает SELECT на каждый элемент
+    пачки"""
+
+    def to_internal_value(self, data):
+        books = self.context.get('books')
+        if books is not None:
+            try:
+                return books[int(data)]
+            except (KeyError, TypeError, ValueError):
+                pass
+        return super().to_internal_value(data)
+
+
+class UserBooksRelationSerializer(TimedRepresentationMixin,
+                                  ModelSerializer):
+    book = BookPrimaryKeyField(queryset=Book.objects.all())
+
     class Meta:
         model = UserBookRelation
         fields = ('book', 'like', 'in_bookmarks', 'rate')
@@ -0,0 +1,75 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from store.cache import invalidate_books
+from store.logic import touch_user_books, update_book_stats
+from store.models import Book, UserBookRelation
+from store.recommendations import record_like_changes
+from store.search import delete_from_search_index, update_search_index
+
+
+@receiver(pre_delete, sender=UserBookRelation)
+def relation_deleting(sender, instance, **kwargs):
+    # Лайк удаляемой связи снимается до удаления, пока остальные лайки
+    # пользователя на месте: пары с ними теряют по единице co_count.
+    # like=False пишется в строку сразу, чтобы при удалении нескольких
+    # связей пользователя (каскадом от пользователя) пара двух удаляемых
+    # книг уменьшилась один раз, а не дважды
+    if instance.like and UserBookRelation.objects.filter(
+            pk=instance.pk, like=True).update(like=False):
+        record_like_changes(instance.user_id, removed=[instance.book_id])
+
+
+@receiver(post_delete, sender=UserBookRelation)
+def relation_deleted(sender, instance, **kwargs):
+    # Удаление связи (в том числе каскадом от пользователя) должно убрать
+    # ее лайк и оценку из счетчиков книги
+    update_book_stats(
+        instance.book_id,
+        likes_delta=-int(instance.like),
+        old_rate=instance.rate
+    )
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def book_changed(sender, instance, **kwargs):
+    invalidate_books([instance.pk])
+
+
+@receiver(post_save, sender=UserBookRelation)
+@receiver(post_delete, sender=UserBookRelation)
+def relation_changed(sender, instance, **kwargs):
+    # Связь меняет лайки, рейтинг и читателей книги в ответе
+    invalidate_books([instance.book_id])
+
+
+# Поля пользователя, которые попадают в JSON книги
+USER_BOOK_FIELDS = {'username', 'first_name', 'last_name'}
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields, **kwargs):
+    # Вход в систему сохраняет только last_login - книги не меняются
+    if created or update_fields is not None and \
+            not USER_BOOK_FIELDS & set(update_fields):
+        return
+    touch_user_books(instance.pk)
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, **kwargs):
+    # owner станет NULL через SET_NULL одним UPDATE, без сигналов Book
+    touch_user_books(instance.pk)
+
+
+@receiver(post_save, sender=Book)
+def book_saved_search(sender, instance, using, update_fields, **kwargs):
+    if update_fields is None or {'name', 'author_name'} & set(update_fields):
+        update_search_index([instance], using=using)
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted_search(sender, instance, using, **kwargs):
+    delete_from_search_index([instance.pk], using=using)
@@ -1,8 +1,9 @@
 import json
+from base64 import b64encode
+from unittest import mock
 
 from django.contrib.auth.models import User
 from django.db import connection
-from django.db.models import Count, Case, When, Avg
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.exceptions import ErrorDetail
@@ -12,6 +13,7 @@ from django.test.utils import CaptureQueriesContext
 
 from store.models import Book, UserBookRelation
 from store.serializers import BookSerializer
+from store.views import BookViewSet, UserBooksRelationView
 
 
 class BooksApiTestCase(APITestCase):
@@ -41,39 +43,58 @@ class BooksApiTestCase(APITestCase):
         url = reverse('book-list')
         # Чтобы протестировать .select_related и .prefetch_related Т.е.
         # делаем запрос и внутри него отлавливаем queries
+        # (книги и читатели)
         with CaptureQueriesContext(connection) as queries:
             response = self.client.get(url)
             self.assertEqual(2, len(queries))
-        books = Book.objects.all().annotate(
-            annotated_likes=Count(Case(When(
-                userbookrelation__like=True,
-                then=1
-            )))
-        ).order_by('id')
+        books = Book.objects.all().order_by('id')
         serializer_data = BookSerializer(
             books,
             many=True
         ).data
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
+
+    def test_get_values(self):
+        """Тест проверяет, что список читает только нужные колонки: без
+        полных User владельца и читателей."""
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('book-list'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        for query in queries.captured_queries:
+            self.assertNotIn('password', query['sql'])
+        self.assertEqual('test_username',
+                         response.data['results'][0]['owner_name'])
+        self.assertEqual([{'first_name': '', 'last_name': ''}],
+                         response.data['results'][0]['readers'])
 
     def test_get_filter(self):
         """Тест проверяет фильтрацию..."""
         url = reverse('book-list')
-        books = Book.objects.filter(id__in=[self.book_1.id,
-                                            self.book_3.id]).annotate(
-            annotated_likes=Count(Case(When(
-                userbookrelation__like=True,
-                then=1
-            )))
-        )
+        # Результаты поиска отсортированы по релевантности: у book_3 "Author"
+        # есть и в названии, и в авторе
+        books = [self.book_3, self.book_1]
         response = self.client.get(url, data={'search': 'Author 1'})
         serializer_data = BookSerializer(
             books,
             many=True
         ).data
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
+
+    def test_get_search_prefix(self):
+        """Тест проверяет поиск по началу слова и вместе с ?ordering."""
+        url = reverse('book-list')
+        response = self.client.get(url, data={'search': 'auth',
+                                              'ordering': '-price'})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([self.book_3.id, self.book_2.id, self.book_1.id],
+                         [book['id'] for book in response.data['results']])
+
+        response = self.client.get(url, data={'search': 'Missing'})
+        self.assertEqual([], response.data['results'])
 
     def test_get_sorting(self):
         """Тест проверяет функционал сортировки."""
@@ -82,19 +103,214 @@ class BooksApiTestCase(APITestCase):
             self.book_3.id,
             self.book_2.id,
             self.book_1.id,
-        ]).annotate(
-            annotated_likes=Count(Case(When(
-                userbookrelation__like=True,
-                then=1
-            )))
-        ).order_by('-id')
+        ]).order_by('-id')
         response = self.client.get(url, data={'ordering': '-price'})
         serializer_data = BookSerializer(
             books,
             many=True
         ).data
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
+
+    def test_get_pagination(self):
+        """Тест проверяет keyset пагинацию: проход вперед и назад по
+        курсорам с сортировкой."""
+        url = reverse('book-list')
+        response = self.client.get(url, data={'ordering': '-price',
+                                              'page_size': 2})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([self.book_3.id, self.book_2.id],
+                         [book['id'] for book in response.data['results']])
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([self.book_1.id],
+                         [book['id'] for book in response.data['results']])
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([self.book_3.id, self.book_2.id],
+                         [book['id'] for book in response.data['results']])
+        self.assertIsNone(response.data['previous'])
+
+    def test_get_pagination_invalid_cursor(self):
+        url = reverse('book-list')
+        response = self.client.get(url, data={'cursor': 'garbage'})
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+        for position in (['abc', 1], [1000, 'abc'], [None, 1], [{}, 1]):
+            cursor = b64encode(json.dumps({
+                'o': ['-price', '-id'], 'p': position
+            }).encode()).decode()
+            response = self.client.get(url, data={'ordering': '-price',
+                                                  'cursor': cursor})
+            self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_get_readers_preview(self):
+        """Тест проверяет режим ?readers_limit: первые N читателей книги и их
+        общее количество."""
+        for number in range(3):
+            user = User.objects.create(username=f'reader_{number}',
+                                       first_name=f'first_name_{number}')
+            UserBookRelation.objects.create(user=user, book=self.book_1)
+        url = reverse('book-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={'readers_limit': 2})
+            self.assertEqual(2, len(queries))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        book_1, book_2, _ = response.data['results']
+        self.assertEqual(3, book_1['readers_count'])
+        self.assertEqual(['first_name_0', 'first_name_1'],
+                         [reader['first_name']
+                          for reader in book_1['readers']])
+        self.assertEqual(0, book_2['readers_count'])
+        self.assertEqual([], book_2['readers'])
+
+        url = reverse('book-detail', args=(self.book_1.id,))
+        response = self.client.get(url, data={'readers_limit': 1})
+        self.assertEqual(3, response.data['readers_count'])
+        self.assertEqual(1, len(response.data['readers']))
+
+        response = self.client.get(url, data={'readers_limit': 1000})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_get_stream(self):
+        """Тест проверяет потоковый список: тот же JSON, что и у
+        сериализатора, книги и читатели - по запросу на пачку."""
+        UserBookRelation.objects.create(user=self.user, book=self.book_2)
+        url = reverse('book-stream')
+        with mock.patch.object(BookViewSet, 'stream_chunk_size', 2), \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={'ordering': '-price'})
+            content = b''.join(response.streaming_content)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        books = Book.objects.order_by('-price')
+        self.assertEqual(json.loads(json.dumps(
+            BookSerializer(books, many=True).data)), json.loads(content))
+        # 2 пачки: книги + читатели на каждую
+        self.assertLessEqual(len(queries), 4)
+
+    def test_get_rating_histogram(self):
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        rate=5)
+        url = reverse('book-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url,
+                                       data={'expand': 'rating_histogram'})
+        # Столько же запросов, сколько без гистограммы
+        self.assertEqual(2, len(queries))
+        self.assertEqual(
+            [[0, 0, 0, 0, 1], [0, 0, 0, 0, 0], [0, 0, 0, 0, 0]],
+            [book['rating_histogram'] for book in response.data['results']]
+        )
+        response = self.client.get(reverse('book-detail',
+                                           args=(self.book_1.id,)),
+                                   data={'expand': 'rating_histogram'})
+        self.assertEqual([0, 0, 0, 0, 1], response.data['rating_histogram'])
+
+        response = self.client.get(url)
+        self.assertNotIn('rating_histogram', response.data['results'][0])
+        response = self.client.get(url, data={'expand': 'unknown'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_get_sparse_fields(self):
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True, rate=4)
+        url = reverse('book-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={'fields': 'id,name',
+                                                  'ordering': '-price',
+                                                  'page_size': 2})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        # Один запрос: без читателей и без JOIN пользователей
+        self.assertEqual(1, len(queries))
+        self.assertNotIn('auth_user', queries[0]['sql'])
+        self.assertEqual([{'id': self.book_3.id,
+                           'name': 'Test book Author 1'},
+                          {'id': self.book_2.id, 'name': 'Test book 2'}],
+                         response.data['results'])
+        # Курсор строится по price, которого нет в ответе
+        response = self.client.get(response.data['next'])
+        self.assertEqual([{'id': self.book_1.id, 'name': 'Test book 1'}],
+                         response.data['results'])
+
+        url = reverse('book-detail', args=(self.book_1.id,))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={
+                'fields': 'annotated_likes,rating_histogram'
+            })
+        self.assertEqual(2, len(queries))
+        # Только колонки выводимых полей
+        self.assertNotIn('auth_user', queries[1]['sql'])
+        self.assertNotIn('"store_book"."name"', queries[1]['sql'])
+        self.assertEqual({'annotated_likes': 1,
+                          'rating_histogram': [0, 0, 0, 1, 0]},
+                         response.data)
+        response = self.client.get(url, data={'fields': 'name,owner_name',
+                                              'readers_limit': 1})
+        self.assertEqual({'name': 'Test book 1',
+                          'owner_name': 'test_username'}, response.data)
+        response = self.client.get(url, data={'fields': 'readers_count',
+                                              'readers_limit': 1})
+        self.assertEqual({'readers_count': 1}, response.data)
+
+        # Без ?ordering= в запросе нет лишних колонок сортировки
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('book-list'), data={'fields': 'name'})
+        self.assertNotIn('"store_book"."price"', queries[0]['sql'])
+        # У лидербордов нет читателей
+        response = self.client.get(reverse('book-top-rated'),
+                                   data={'fields': 'readers'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+        response = self.client.get(url, data={'fields': 'id,unknown'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.client.get(url, data={'fields': ''})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_get_leaderboards(self):
+        user_2 = User.objects.create(username='test_username_2')
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True, rate=3)
+        UserBookRelation.objects.create(user=user_2, book=self.book_1,
+                                        like=True)
+        UserBookRelation.objects.create(user=self.user, book=self.book_2,
+                                        like=True, rate=5)
+        UserBookRelation.objects.create(user=user_2, book=self.book_3,
+                                        rate=4)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('book-top-rated'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        # Только чтение начала индекса
+        self.assertEqual(1, len(queries))
+        self.assertEqual(
+            [(self.book_2.id, '5.00'), (self.book_3.id, '4.00'),
+             (self.book_1.id, '3.00')],
+            [(book['id'], book['rating']) for book in response.data]
+        )
+        self.assertNotIn('readers', response.data[0])
+
+        response = self.client.get(reverse('book-most-liked'),
+                                   data={'limit': 1})
+        self.assertEqual([(self.book_1.id, 2)],
+                         [(book['id'], book['annotated_likes'])
+                          for book in response.data])
+        response = self.client.get(reverse('book-most-liked'),
+                                   data={'author': 'Author 2'})
+        self.assertEqual([self.book_2.id],
+                         [book['id'] for book in response.data])
+
+        # Новая оценка сразу меняет лидерборд (кэш ответов по версии)
+        UserBookRelation.objects.create(user=user_2, book=self.book_2,
+                                        rate=1)
+        response = self.client.get(reverse('book-top-rated'),
+                                   data={'limit': 1})
+        self.assertEqual([self.book_3.id],
+                         [book['id'] for book in response.data])
+
+        response = self.client.get(reverse('book-top-rated'),
+                                   data={'limit': 1000})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
 
     # py manage.py test store.tests.test_api.BooksApiTestCase.test_create
     def test_create(self):
@@ -257,6 +473,27 @@ class BooksRelationTestCase(APITestCase):
         relation = UserBookRelation.objects.get(user=self.user,
                                                 book=self.book_1)
         self.assertTrue(relation.like)
+        self.book_1.refresh_from_db()
+        self.assertEqual(1, self.book_1.likes_count)
+
+    def test_unlike(self):
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True)
+        UserBookRelation.objects.create(user=self.user_2, book=self.book_1,
+                                        like=True)
+        url = reverse(
+            'userbookrelation-detail',
+            args=(self.book_1.id,)
+        )
+        self.client.force_login(self.user)
+        response = self.client.patch(
+            url,
+            data=json.dumps({"like": False}),
+            content_type='application/json'
+        )
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.book_1.refresh_from_db()
+        self.assertEqual(1, self.book_1.likes_count)
 
     # py manage.py test store.tests.test_api.BooksRelationTestCase.test_in_bookmarks
     def test_in_bookmarks(self):
@@ -315,3 +552,149 @@ class BooksRelationTestCase(APITestCase):
             content_type='application/json'
         )
         self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_rate_upsert_single_statement(self):
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True, rate=5)
+        url = reverse('userbookrelation-detail', args=(self.book_1.id,))
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(
+                url,
+                data=json.dumps({'rate': 3, 'like': False}),
+                content_type='application/json'
+            )
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(3, response.data['rate'])
+        if connection.vendor == 'postgresql':
+            relation_queries = [
+                query for query in queries.captured_queries
+                if 'store_userbookrelation' in query['sql']
+            ]
+            self.assertEqual(1, len(relation_queries))
+        self.book_1.refresh_from_db()
+        self.assertEqual(0, self.book_1.likes_count)
+        self.assertEqual('3.00', str(self.book_1.rating))
+
+    def test_rate_missing_book(self):
+        url = reverse('userbookrelation-detail', args=(0,))
+        self.client.force_login(self.user)
+        response = self.client.patch(
+            url,
+            data=json.dumps({'like': True}),
+            content_type='application/json'
+        )
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+        self.assertFalse(UserBookRelation.objects.filter(book_id=0).exists())
+
+    def test_bulk(self):
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True, rate=5)
+        UserBookRelation.objects.create(user=self.user_2, book=self.book_2,
+                                        rate=1)
+        url = reverse('userbookrelation-bulk')
+        data = [
+            {'book': self.book_1.id, 'like': False},
+            {'book': self.book_2.id, 'like': True, 'rate': 4},
+            {'book': self.book_1.id, 'rate': 2},
+        ]
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(url, data=json.dumps(data),
+                                         content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([
+            {'book': self.book_1.id, 'like': False, 'in_bookmarks': False,
+             'rate': 2},
+            {'book': self.book_2.id, 'like': True, 'in_bookmarks': False,
+             'rate': 4},
+        ], response.data)
+        # Число запросов не зависит от размера пачки
+        self.assertLessEqual(len(queries), 10)
+
+        self.book_1.refresh_from_db()
+        self.book_2.refresh_from_db()
+        self.assertEqual(0, self.book_1.likes_count)
+        self.assertEqual('2.00', str(self.book_1.rating))
+        self.assertEqual(1, self.book_2.likes_count)
+        self.assertEqual(2, self.book_2.rating_count)
+        self.assertEqual('2.50', str(self.book_2.rating))
+
+    def test_bulk_max_size(self):
+        books = Book.objects.bulk_create(
+            Book(name=f'Book {number}', price=1000, author_name='Author 1')
+            for number in range(UserBooksRelationView.max_bulk_size)
+        )
+        UserBookRelation.objects.bulk_create(
+            UserBookRelation(user=self.user, book=book) for book in books[::2]
+        )
+        self.client.force_login(self.user)
+        response = self.client.patch(
+            reverse('userbookrelation-bulk'),
+            data=json.dumps([{'book': book.id, 'in_bookmarks': True}
+                             for book in books]),
+            content_type='application/json'
+        )
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(len(books), UserBookRelation.objects.filter(
+            user=self.user, in_bookmarks=True).count())
+
+    def test_bulk_wrong(self):
+        url = reverse('userbookrelation-bulk')
+        data = [
+            {'book': self.book_1.id, 'like': True},
+            {'book': self.book_2.id, 'rate': 6},
+        ]
+        self.client.force_login(self.user)
+        response = self.client.post(url, data=json.dumps(data),
+                                    content_type='application/json')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertFalse(UserBookRelation.objects.exists())
+
+    def test_feeds(self):
+        book_3 = Book.objects.create(name='Test book 3', price=3000,
+                                     author_name='Author 3')
+        UserBookRelation.objects.create(user=self.user, book=self.book_2,
+                                        like=True, rate=4)
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        in_bookmarks=True)
+        UserBookRelation.objects.create(user=self.user, book=book_3,
+                                        like=True)
+        UserBookRelation.objects.create(user=self.user_2, book=self.book_1,
+                                        like=True)
+        self.client.force_login(self.user)
+
+        url = reverse('userbookrelation-liked')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={'page_size': 1})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        # Одна выборка, без prefetch читателей
+        self.assertEqual(1, len([query for query in queries.captured_queries
+                                 if 'store_book' in query['sql']]))
+        # Новые связи первыми
+        self.assertEqual([{
+            'id': book_3.id,
+            'name': 'Test book 3',
+            'price': '3000.00',
+            'author_name': 'Author 3',
+            'annotated_likes': 1,
+            'rating': None,
+            'owner_name': '',
+            'like': True,
+            'in_bookmarks': False,
+            'rate': None,
+        }], response.data['results'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([self.book_2.id],
+                         [book['id'] for book in response.data['results']])
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(reverse('userbookrelation-bookmarked'))
+        self.assertEqual([self.book_1.id],
+                         [book['id'] for book in response.data['results']])
+        self.assertEqual('test_username',
+                         response.data['results'][0]['owner_name'])
+        response = self.client.get(reverse('userbookrelation-rated'))
+        self.assertEqual([(self.book_2.id, 4)],
+                         [(book['id'], book['rate'])
+                          for book in response.data['results']])
@@ -0,0 +1,82 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+
+from books.urls import urlpatterns as project_urlpatterns
+from store import async_views
+from store.models import Book
+from store.serializers import BookSerializer
+
+# Модуль теста служит ROOT_URLCONF: async маршруты книг + все остальные
+urlpatterns = async_views.urlpatterns + project_urlpatterns
+
+
+# Запросы к БД в потоке теста, чтобы видеть данные его транзакции
+@override_settings(ROOT_URLCONF='store.tests.test_async_views',
+                   BOOKS_ASYNC_THREAD_SENSITIVE=True)
+class AsyncBookViewsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book = Book.objects.create(name='Test book 1', price=1000,
+                                        author_name='Author 1',
+                                        owner=self.user)
+
+    async def test_list(self):
+        url = reverse('book-list')
+        response = await self.async_client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        books = await sync_to_async(
+            lambda: BookSerializer(Book.objects.order_by('id'),
+                                   many=True).data)()
+        self.assertEqual(json.loads(json.dumps(books)),
+                         response.json()['results'])
+
+        # Повтор - из кэша, без БД
+        cached = await self.async_client.get(url)
+        self.assertIn('desc="0 queries"', cached['Server-Timing'])
+        self.assertEqual(response.content, cached.content)
+
+        # Версии в памяти процесса - у списка нет ETag
+        self.assertNotIn('ETag', cached)
+
+    async def test_detail(self):
+        response = await self.async_client.get(
+            reverse('book-detail', args=(self.book.id,)))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('Test book 1', response.json()['name'])
+        # Валидаторы книги (updated_at), а не списка
+        self.assertIn('Last-Modified', response)
+
+        # Повтор с ETag - 304 из кэша. AsyncClient в Django 4.0 принимает
+        # заголовки по их HTTP имени
+        cached = await self.async_client.get(
+            reverse('book-detail', args=(self.book.id,)),
+            **{'If-None-Match': response['ETag']})
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, cached.status_code)
+
+        response = await self.async_client.get(
+            reverse('book-detail', args=(0,)))
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    async def test_write_permissions(self):
+        response = await self.async_client.delete(
+            reverse('book-detail', args=(self.book.id,)))
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+    async def test_list_actions(self):
+        """Действия списка не перехватываются маршрутом книги"""
+        for name in ('book-stream', 'book-export', 'book-top-rated',
+                     'book-most-liked'):
+            response = await self.async_client.get(reverse(name))
+            self.assertEqual(status.HTTP_200_OK, response.status_code, name)
+        response = await self.async_client.get(
+            reverse('book-similar', args=(self.book.id,)))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        # Не 405 от маршрута книги: import только для администратора
+        response = await self.async_client.post(reverse('book-import'))
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
@@ -0,0 +1,46 @@
+import json
+import os
+
+from django.db import connection
+from django.test import TestCase
+
+from store.benchmarks import run_benchmarks
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__),
+                             'benchmark_baseline.json')
+
+
+class BenchmarkBaselineTestCase(TestCase):
+    """Сравнивает сценарии store/benchmarks.py с сохраненным baseline.
+    Обновить baseline: python manage.py benchmark_store --baseline
+    store/tests/benchmark_baseline.json
+
+    Число запросов должно совпадать с baseline: и рост, и снижение значат,
+    что baseline устарел и его нужно обновить вместе с изменением. Размер
+    ответа и память не должны выходить за допуск. Время только
+    записывается: на общих машинах оно слишком шумное для проверки."""
+    size_tolerance = 0.1
+    memory_factor = 3
+
+    def test_baseline(self):
+        with open(BASELINE_PATH) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['vendor'] != connection.vendor:
+            self.skipTest(f'baseline записан на {baseline["vendor"]}')
+
+        results = run_benchmarks(baseline['params'])
+        self.assertEqual(set(baseline['scenarios']),
+                         set(results['scenarios']))
+        for name, expected in baseline['scenarios'].items():
+            actual = results['scenarios'][name]
+            with self.subTest(scenario=name):
+                self.assertEqual(expected['status'], actual['status'])
+                self.assertEqual(expected['queries'], actual['queries'])
+                self.assertAlmostEqual(
+                    expected['size'], actual['size'],
+                    delta=expected['size'] * self.size_tolerance
+                )
+                self.assertLessEqual(
+                    actual['peak_kb'],
+                    expected['peak_kb'] * self.memory_factor
+                )
@@ -0,0 +1,204 @@
+import json
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from store.cache import get_response_cache, LocMemLRUBackend
+from store.models import Book, UserBookRelation
+
+
+class LocMemLRUBackendTestCase(SimpleTestCase):
+    def test_eviction(self):
+        backend = LocMemLRUBackend(max_entries=2)
+        backend.set('a', b'1', 60)
+        backend.set('b', b'2', 60)
+        # 'a' использовали последним, вытеснится 'b'
+        backend.get('a')
+        backend.set('c', b'3', 60)
+        self.assertEqual(b'1', backend.get('a'))
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(b'3', backend.get('c'))
+
+    def test_timeout(self):
+        backend = LocMemLRUBackend()
+        with mock.patch('store.cache.time.monotonic', return_value=100):
+            backend.set('a', b'1', 10)
+        with mock.patch('store.cache.time.monotonic', return_value=105):
+            self.assertEqual(b'1', backend.get('a'))
+        with mock.patch('store.cache.time.monotonic', return_value=111):
+            self.assertIsNone(backend.get('a'))
+
+    def test_versions(self):
+        backend = LocMemLRUBackend()
+        version = backend.get_version('books')
+        self.assertEqual(version, backend.get_version('books'))
+        backend.bump_version('books')
+        self.assertNotEqual(version, backend.get_version('books'))
+
+
+class ResponseCacheApiTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book_1 = Book.objects.create(
+            name='Test book 1',
+            price=1000,
+            author_name='Author 1',
+            owner=self.user
+        )
+
+    def test_list_hit_and_invalidation(self):
+        url = reverse('book-list')
+        response = self.client.get(url, data={'ordering': 'price'})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get(url, data={'ordering': 'price'})
+        self.assertEqual(0, len(queries))
+        self.assertEqual(response.content, cached.content)
+
+        self.client.force_login(self.user)
+        self.client.patch(
+            reverse('userbookrelation-detail', args=(self.book_1.id,)),
+            data=json.dumps({'like': True}),
+            content_type='application/json'
+        )
+        response = self.client.get(url, data={'ordering': 'price'})
+        self.assertEqual(1, response.json()['results'][0]['annotated_likes'])
+
+    def test_detail_invalidation(self):
+        url = reverse('book-detail', args=(self.book_1.id,))
+        self.assertEqual('Test book 1', self.client.get(url).json()['name'])
+        self.book_1.name = 'New name'
+        self.book_1.save()
+        self.assertEqual('New name', self.client.get(url).json()['name'])
+
+    def test_detail_pk_normalized(self):
+        url = f'/book/0{self.book_1.id}/'
+        self.assertEqual('Test book 1', self.client.get(url).json()['name'])
+        self.book_1.name = 'New name'
+        self.book_1.save()
+        self.assertEqual('New name', self.client.get(url).json()['name'])
+        cache = get_response_cache()
+        self.assertEqual(cache.detail_key(f'0{self.book_1.id}', {}),
+                         cache.detail_key(self.book_1.id, {}))
+
+    def test_query_escaped(self):
+        """Экранированный '&' в значении - другой запрос и другой ключ"""
+        Book.objects.create(name='Test book 2', price=500,
+                            author_name='Author 1')
+        url = reverse('book-list')
+        self.client.get(f'{url}?ordering=-price%26search%3D2')
+        response = self.client.get(url, data={'ordering': '-price',
+                                              'search': '2'})
+        self.assertEqual(['Test book 2'],
+                         [book['name'] for book in response.json()['results']])
+
+
+class ConditionalGetTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book_1 = Book.objects.create(
+            name='Test book 1',
+            price=1000,
+            author_name='Author 1'
+        )
+
+    def test_detail_etag(self):
+        url = reverse('book-detail', args=(self.book_1.id,))
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        # Ни queryset книги, ни читателей: максимум запрос версии
+        self.assertLessEqual(len(queries), 1)
+
+        # Лайк меняет updated_at книги, а значит и ETag
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_detail_not_number(self):
+        response = self.client.get('/book/abc/')
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_detail_owner_renamed(self):
+        self.book_1.owner = self.user
+        self.book_1.save()
+        url = reverse('book-detail', args=(self.book_1.id,))
+        etag = self.client.get(url)['ETag']
+
+        # Имя владельца есть в JSON книги
+        self.user.username = 'new_username'
+        self.user.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('new_username', response.json()['owner_name'])
+
+        etag = response['ETag']
+        self.user.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('', response.json()['owner_name'])
+
+    def test_detail_reader_renamed(self):
+        UserBookRelation.objects.create(user=self.user, book=self.book_1)
+        url = reverse('book-detail', args=(self.book_1.id,))
+        etag = self.client.get(url)['ETag']
+
+        self.user.first_name = 'Ivan'
+        self.user.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('Ivan', response.json()['readers'][0]['first_name'])
+
+    @override_settings(BOOKS_RESPONSE_CACHE={
+        'BACKEND': 'store.cache.DjangoCacheBackend'
+    })
+    def test_list_etag(self):
+        """ETag списка - только по версии в общем для процессов кэше"""
+        url = reverse('book-list')
+        response = self.client.get(url)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self.assertEqual(0, len(queries))
+
+        self.book_1.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_list_local_versions(self):
+        """Версии LocMemLRUBackend не видят записей других процессов: у
+        списка нет ETag, но сам ответ кэшируется"""
+        url = reverse('book-list')
+        response = self.client.get(url)
+        self.assertNotIn('ETag', response)
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get(url, HTTP_IF_NONE_MATCH='"x"')
+        self.assertEqual(0, len(queries))
+        self.assertEqual(status.HTTP_200_OK, cached.status_code)
+        self.assertNotIn('ETag', cached)
+
+    @override_settings(BOOKS_RESPONSE_CACHE=None)
+    def test_list_without_cache(self):
+        """Без кэша ответов у списка нет дешевой версии: валидаторов нет,
+        лишнего запроса тоже"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('book-list'))
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotIn('ETag', response)
+        self.assertEqual(2, len(queries))
@@ -0,0 +1,76 @@
+from unittest import skipUnless
+
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase
+
+from books.db_backends.postgresql import base
+
+
+@skipUnless(connection.vendor == 'postgresql', 'PostgreSQL backend')
+class DatabaseWrapperTestCase(SimpleTestCase):
+    """Отдельные соединения с тестовой БД, мимо соединения теста"""
+
+    def setUp(self):
+        # Выполнится последним, после закрытия всех wrapper
+        self.addCleanup(self.close_pools)
+
+    def close_pools(self):
+        for pool in base._pools.values():
+            for raw_connection in pool._idle:
+                raw_connection.close()
+        base._pools.clear()
+
+    def make_wrapper(self, **overrides):
+        wrapper = base.DatabaseWrapper(
+            {**connection.settings_dict, **overrides},
+            alias='backend_test'
+        )
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def select_one(self, wrapper):
+        with wrapper.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            return cursor.fetchone()[0]
+
+    def test_health_check(self):
+        wrapper = self.make_wrapper(CONN_MAX_AGE=60, CONN_HEALTH_CHECKS=True)
+        self.assertEqual(1, self.select_one(wrapper))
+        # Сервер разорвал соединение между запросами
+        broken = wrapper.connection
+        broken.close()
+        wrapper.close_if_unusable_or_obsolete()
+        self.assertEqual(1, self.select_one(wrapper))
+        self.assertIsNot(broken, wrapper.connection)
+
+    def test_pool(self):
+        pool = {'MAX_SIZE': 1, 'TIMEOUT': 0.1}
+        wrapper = self.make_wrapper(POOL=pool)
+        self.select_one(wrapper)
+        raw_connection = wrapper.connection
+        wrapper.close()
+        self.assertFalse(raw_connection.closed)
+
+        other = self.make_wrapper(POOL=pool)
+        self.select_one(other)
+        self.assertIs(raw_connection, other.connection)
+        # Единственное соединение пула занято
+        with self.assertRaises(OperationalError):
+            self.select_one(self.make_wrapper(POOL=pool))
+
+    def test_pool_health_check(self):
+        pool = {'MAX_SIZE': 2, 'TIMEOUT': 0.1}
+        wrapper = self.make_wrapper(POOL=pool, CONN_HEALTH_CHECKS=True)
+        self.select_one(wrapper)
+        dead = wrapper.connection
+        wrapper.close()
+        # Сервер разорвал свободное соединение пула (ждем завершения
+        # процесса до 5 секунд)
+        with self.make_wrapper().cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s, 5000)',
+                           [dead.get_backend_pid()])
+
+        other = self.make_wrapper(POOL=pool, CONN_HEALTH_CHECKS=True)
+        self.assertEqual(1, self.select_one(other))
+        self.assertIsNot(dead, other.connection)
+        self.assertTrue(dead.closed)
@@ -1,7 +1,11 @@
 from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.db.models import Value
+from django.test.utils import CaptureQueriesContext
 
-from store.logic import set_rating
+from store.logic import bulk_upsert_relations, compute_rating, \
+    rating_expression, set_rating, reconcile_likes_count, reconcile_rating
 from store.models import Book, UserBookRelation
 
 
@@ -41,3 +45,179 @@ class SetRatingTestCase(TestCase):
         set_rating(self.book_1)
         self.book_1.refresh_from_db()
         self.assertEqual('4.67', str(self.book_1.rating))
+
+
+class LikesCountTestCase(TestCase):
+    def setUp(self):
+        self.user_1 = User.objects.create(username='user_1')
+        self.user_2 = User.objects.create(username='user_2')
+        self.book_1 = Book.objects.create(
+            name='Test book 1',
+            price=1000,
+            author_name='Author 1'
+        )
+        self.relation = UserBookRelation.objects.create(
+            user=self.user_1, book=self.book_1, like=True)
+        UserBookRelation.objects.create(user=self.user_2, book=self.book_1,
+                                        like=True)
+
+    def test_counter(self):
+        self.book_1.refresh_from_db()
+        self.assertEqual(2, self.book_1.likes_count)
+
+        relation = UserBookRelation.objects.get(pk=self.relation.pk)
+        relation.like = False
+        relation.save()
+        self.book_1.refresh_from_db()
+        self.assertEqual(1, self.book_1.likes_count)
+
+        # Повторное сохранение без изменения like счетчик не трогает
+        relation.save()
+        self.book_1.refresh_from_db()
+        self.assertEqual(1, self.book_1.likes_count)
+
+    def test_delete(self):
+        self.user_2.delete()
+        self.book_1.refresh_from_db()
+        self.assertEqual(1, self.book_1.likes_count)
+
+    def test_reconcile(self):
+        Book.objects.filter(pk=self.book_1.pk).update(likes_count=10)
+        self.assertEqual(1, reconcile_likes_count())
+        self.book_1.refresh_from_db()
+        self.assertEqual(2, self.book_1.likes_count)
+        self.assertEqual(0, reconcile_likes_count())
+
+
+class RatingTestCase(TestCase):
+    def setUp(self):
+        self.user_1 = User.objects.create(username='user_1')
+        self.user_2 = User.objects.create(username='user_2')
+        self.book_1 = Book.objects.create(
+            name='Test book 1',
+            price=1000,
+            author_name='Author 1'
+        )
+        UserBookRelation.objects.create(user=self.user_1, book=self.book_1,
+                                        rate=5)
+
+    def test_create_without_aggregate(self):
+        with CaptureQueriesContext(connection) as queries:
+            UserBookRelation.objects.create(user=self.user_2,
+                                            book=self.book_1, rate=4)
+        self.assertFalse(any('AVG(' in query['sql'] or 'SUM(' in query['sql']
+                             for query in queries))
+        self.book_1.refresh_from_db()
+        self.assertEqual(9, self.book_1.rating_sum)
+        self.assertEqual(2, self.book_1.rating_count)
+        self.assertEqual('4.50', str(self.book_1.rating))
+
+    def test_change_and_clear(self):
+        relation = UserBookRelation.objects.get(user=self.user_1,
+                                                book=self.book_1)
+        relation.rate = 2
+        relation.save()
+        self.book_1.refresh_from_db()
+        self.assertEqual(2, self.book_1.rating_sum)
+        self.assertEqual('2.00', str(self.book_1.rating))
+
+        relation.rate = None
+        relation.save()
+        self.book_1.refresh_from_db()
+        self.assertEqual(0, self.book_1.rating_count)
+        self.assertIsNone(self.book_1.rating)
+
+    def get_histogram(self):
+        return list(Book.objects.filter(pk=self.book_1.pk).values_list(
+            *Book.RATE_FIELDS).get())
+
+    def test_histogram(self):
+        relation = UserBookRelation.objects.create(user=self.user_2,
+                                                   book=self.book_1, rate=4)
+        self.assertEqual([0, 0, 0, 1, 1], self.get_histogram())
+        relation.rate = 1
+        relation.save()
+        self.assertEqual([1, 0, 0, 0, 1], self.get_histogram())
+        bulk_upsert_relations(self.user_1.id, [
+            {'book': self.book_1, 'rate': 1},
+        ])
+        self.assertEqual([2, 0, 0, 0, 0], self.get_histogram())
+        relation.delete()
+        self.assertEqual([1, 0, 0, 0, 0], self.get_histogram())
+
+    def test_reconcile(self):
+        Book.objects.filter(pk=self.book_1.pk).update(rating_sum=1,
+                                                      rating=1)
+        self.assertEqual(1, reconcile_rating())
+        self.book_1.refresh_from_db()
+        self.assertEqual(5, self.book_1.rating_sum)
+        self.assertEqual('5.00', str(self.book_1.rating))
+
+        Book.objects.filter(pk=self.book_1.pk).update(rate_5=0, rate_2=3)
+        self.assertEqual(1, reconcile_rating())
+        self.assertEqual([0, 0, 0, 0, 1], self.get_histogram())
+
+        # Расхождение только в rating; книга без оценок (rating NULL) не
+        # считается разошедшейся
+        Book.objects.create(name='Test book 2', price=1000,
+                            author_name='Author 2')
+        Book.objects.filter(pk=self.book_1.pk).update(rating='4.99')
+        self.assertEqual(1, reconcile_rating())
+        self.assertEqual(0, reconcile_rating())
+        self.book_1.refresh_from_db()
+        self.assertEqual('5.00', str(self.book_1.rating))
+
+    def test_rounding(self):
+        """БД и Python округляют одинаково, в том числе ровно посередине
+        (9 / 8 = 1.125)"""
+        cases = [(rating_sum, rating_count)
+                 for rating_count in range(1, 9)
+                 for rating_sum in range(rating_count, rating_count * 5 + 1)]
+        ratings = Book.objects.filter(pk=self.book_1.pk).annotate(**{
+            f'rating_{number}': rating_expression(Value(rating_sum),
+                                                  Value(rating_count))
+            for number, (rating_sum, rating_count) in enumerate(cases)
+        }).values(*(f'rating_{number}' for number in range(len(cases))))
+        self.assertEqual(
+            [compute_rating(*case) for case in cases],
+            list(ratings.get().values())
+        )
+        self.assertEqual('1.13', str(compute_rating(9, 8)))
+
+
+class DirtyFieldsTestCase(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='user_1')
+        book = Book.objects.create(
+            name='Test book 1',
+            price=1000,
+            author_name='Author 1'
+        )
+        relation = UserBookRelation.objects.create(user=user, book=book,
+                                                   rate=3)
+        self.relation = UserBookRelation.objects.get(pk=relation.pk)
+
+    def test_no_changes(self):
+        self.assertEqual({}, self.relation.get_dirty_fields())
+        with CaptureQueriesContext(connection) as queries:
+            self.relation.save()
+        self.assertEqual(0, len(queries))
+
+    def test_partial_update(self):
+        self.relation.in_bookmarks = True
+        self.assertEqual({'in_bookmarks': False},
+                         self.relation.get_dirty_fields())
+        with CaptureQueriesContext(connection) as queries:
+            self.relation.save()
+        updates = [query['sql'] for query in queries
+                   if query['sql'].startswith('UPDATE')]
+        # Счетчики книги не трогаются, в UPDATE связи только одно поле
+        self.assertEqual(1, len(updates))
+        self.assertNotIn('"rate"', updates[0])
+        self.assertEqual({}, self.relation.get_dirty_fields())
+
+    def test_rate_change(self):
+        self.relation.rate = 5
+        self.relation.save()
+        book = Book.objects.get(pk=self.relation.book_id)
+        self.assertEqual('5.00', str(book.rating))
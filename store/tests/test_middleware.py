@@ -0,0 +1,56 @@
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from store.metrics import Histogram, registry
+from store.models import Book
+
+
+class HistogramTestCase(SimpleTestCase):
+    def test_quantile(self):
+        histogram = Histogram(buckets=(1, 10, 100))
+        for value in (0.5, 3, 4, 50, 1000):
+            histogram.observe(value)
+        self.assertEqual(5, histogram.count)
+        self.assertEqual(10, histogram.quantile(0.5))
+        self.assertIsNone(histogram.quantile(0.99))
+        self.assertEqual({'1': 1, '10': 2, '100': 1, '+Inf': 1},
+                         histogram.as_dict()['buckets'])
+
+
+class PerformanceMiddlewareTestCase(APITestCase):
+    def setUp(self):
+        registry.reset()
+        self.user = User.objects.create(username='staff', is_staff=True)
+        Book.objects.create(name='Test book 1', price=1000,
+                            author_name='Author 1')
+
+    def test_server_timing(self):
+        response = self.client.get(reverse('book-list'),
+                                   data={'ordering': 'price'})
+        timing = response['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn('desc="2 queries"', timing)
+        self.assertIn('serialize;dur=', timing)
+        self.assertIn('render;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        stats = registry.snapshot()['book-list']
+        self.assertEqual(1, stats['total']['count'])
+        self.assertEqual(2, stats['queries']['sum'])
+        self.assertEqual(1, stats['serialize']['count'])
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('book-list'))
+        url = reverse('metrics')
+        self.assertEqual(status.HTTP_403_FORBIDDEN,
+                         self.client.get(url).status_code)
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertIn('book-list', response.data)
+
+        self.client.delete(url)
+        self.assertNotIn('book-list', registry.snapshot())
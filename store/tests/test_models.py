@@ -0,0 +1,126 @@
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test import TestCase
+
+from store.models import Book, UserBookRelation
+from store.pagination import KeysetPagination
+
+
+@skipUnless(connection.vendor == 'postgresql', 'EXPLAIN формата PostgreSQL')
+class IndexUsageTestCase(TestCase):
+    """Проверяет через EXPLAIN, что горячие запросы идут по индексам.
+    seq scan запрещаем, чтобы на маленькой таблице планировщик выбирал
+    между индексами, а не между индексом и таблицей."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='user_1')
+        self.book = Book.objects.create(
+            name='Test book 1',
+            price=1000,
+            author_name='Author 1'
+        )
+        # Большинство связей без лайка и оценки, как в реальных данных
+        users = User.objects.bulk_create(
+            User(username=f'reader_{number}') for number in range(500)
+        )
+        UserBookRelation.objects.bulk_create(
+            UserBookRelation(user=user, book=self.book,
+                             like=number < 5,
+                             rate=5 if number < 5 else None)
+            for number, user in enumerate(users)
+        )
+        # Оценки и лайки другой книги: условие по книге должно быть
+        # избирательным, иначе индексы по пользователю не хуже
+        other_book = Book.objects.create(
+            name='Test book 2',
+            price=2000,
+            author_name='Author 2'
+        )
+        UserBookRelation.objects.bulk_create(
+            UserBookRelation(user=user, book=other_book,
+                             like=number < 25,
+                             rate=4 if number < 25 else None)
+            for number, user in enumerate(users)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE store_book')
+            cursor.execute('ANALYZE store_userbookrelation')
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, index_name, queryset):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_relation_lookup(self):
+        self.assertUsesIndex(
+            'store_relation_user_book_uniq',
+            UserBookRelation.objects.filter(user=self.user, book=self.book)
+        )
+
+    def test_book_likes(self):
+        self.assertUsesIndex(
+            'store_rel_book_like_idx',
+            UserBookRelation.objects.filter(
+                book=self.book, like=True
+            ).values('book').annotate(count=Count('id'))
+        )
+
+    def test_book_rates(self):
+        self.assertUsesIndex(
+            'store_rel_book_rate_idx',
+            UserBookRelation.objects.filter(
+                book=self.book, rate__isnull=False
+            ).values('book').annotate(total=Sum('rate'))
+        )
+
+    def test_user_feeds(self):
+        for index_name, condition in (
+                ('store_rel_user_like_idx', {'like': True}),
+                ('store_rel_user_bookmark_idx', {'in_bookmarks': True}),
+                ('store_rel_user_rate_idx', {'rate__isnull': False})):
+            self.assertUsesIndex(
+                index_name,
+                UserBookRelation.objects.filter(
+                    user=self.user, **condition
+                ).order_by('-id')[:20]
+            )
+
+    def test_leaderboards(self):
+        self.assertUsesIndex(
+            'store_book_top_rated_idx',
+            Book.objects.filter(rating__isnull=False).order_by(
+                '-rating', 'id')[:10]
+        )
+        self.assertUsesIndex(
+            'store_book_most_liked_idx',
+            Book.objects.filter(likes_count__gt=0).order_by(
+                '-likes_count', 'id')[:10]
+        )
+
+    def test_book_ordering(self):
+        self.assertUsesIndex(
+            'store_book_price_id_idx',
+            Book.objects.order_by('price', 'id')[:20]
+        )
+        self.assertUsesIndex(
+            'store_book_author_id_idx',
+            Book.objects.filter(author_name__gt='Author').order_by(
+                'author_name', 'id')[:20]
+        )
+
+    def test_keyset_page(self):
+        """Страница после курсора начинается с поиска по индексу, обратная
+        сортировка читает его в обратную сторону без сортировки"""
+        with connection.cursor() as cursor:
+            # На двух книгах bitmap scan с сортировкой дешевле
+            cursor.execute('SET LOCAL enable_bitmapscan = off')
+        for ordering in (('price', 'id'), ('-price', '-id')):
+            plan = Book.objects.order_by(*ordering).filter(
+                KeysetPagination.keyset_filter(ordering, ['1500.00', 1])
+            )[:20].explain()
+            self.assertIn('store_book_price_id_idx', plan)
+            self.assertIn('Index Cond', plan)
+            self.assertNotIn('Sort', plan)
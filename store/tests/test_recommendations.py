@@ -0,0 +1,193 @@
+import json
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from store.models import Book, BookSimilarity, UserBookRelation
+from store.recommendations import DEFAULT_TOP_K, compute_similarities, \
+    record_like_changes
+
+
+class SimilarBooksTestCase(APITestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f'user_{number}')
+                      for number in range(3)]
+        self.books = [Book.objects.create(name=f'Test book {number}',
+                                          price=1000,
+                                          author_name='Author 1')
+                      for number in range(4)]
+
+    def like(self, user, book, like=True):
+        self.client.force_login(user)
+        url = reverse('userbookrelation-detail', args=(book.id,))
+        response = self.client.patch(url, data=json.dumps({'like': like}),
+                                     content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+    def get_pairs(self):
+        return {
+            (book_id, similar_id): co_count
+            for book_id, similar_id, co_count
+            in BookSimilarity.objects.filter(co_count__gt=0).values_list(
+                'book_id', 'similar_id', 'co_count')
+        }
+
+    def test_compute(self):
+        book_0, book_1, book_2, book_3 = self.books
+        for user, books in zip(self.users, ([book_0, book_1, book_2],
+                                            [book_0, book_1],
+                                            [book_0, book_3])):
+            for book in books:
+                UserBookRelation.objects.create(user=user, book=book,
+                                                like=True)
+        UserBookRelation.objects.create(user=self.users[2], book=book_2,
+                                        in_bookmarks=True)
+        BookSimilarity.objects.all().delete()
+
+        compute_similarities(top_k=2, batch_size=2)
+        self.assertEqual({
+            (book_0.id, book_1.id): 2,
+            (book_0.id, book_2.id): 1,
+            (book_1.id, book_0.id): 2,
+            (book_1.id, book_2.id): 1,
+            (book_2.id, book_0.id): 1,
+            (book_2.id, book_1.id): 1,
+            (book_3.id, book_0.id): 1,
+        }, self.get_pairs())
+
+    def test_incremental(self):
+        """Лайки через PATCH, bulk и save() дают те же co_count, что и
+        полный пересчет"""
+        book_0, book_1, book_2, book_3 = self.books
+        self.like(self.users[0], book_0)
+        self.like(self.users[0], book_1)
+        self.like(self.users[1], book_1)
+        self.like(self.users[1], book_2)
+        self.like(self.users[0], book_2)
+        self.like(self.users[0], book_0, like=False)
+        self.client.force_login(self.users[1])
+        self.client.post(
+            reverse('userbookrelation-bulk'),
+            data=json.dumps([
+                {'book': book_0.id, 'like': True},
+                {'book': book_3.id, 'like': True},
+                {'book': book_2.id, 'like': False},
+            ]),
+            content_type='application/json'
+        )
+        relation = UserBookRelation.objects.get(user=self.users[0],
+                                                book=book_1)
+        relation.like = False
+        relation.save()
+        UserBookRelation.objects.create(user=self.users[2], book=book_3,
+                                        like=True)
+        UserBookRelation.objects.create(user=self.users[2], book=book_0,
+                                        like=True)
+
+        incremental = self.get_pairs()
+        compute_similarities(top_k=10)
+        self.assertEqual(self.get_pairs(), incremental)
+        self.assertEqual(2, incremental[book_0.id, book_3.id])
+
+    def test_deleted(self):
+        """Удаление связи и пользователя (каскадом) убирает его лайки из
+        co_count"""
+        book_0, book_1, book_2, book_3 = self.books
+        for user in self.users[:2]:
+            for book in (book_0, book_1, book_2):
+                self.like(user, book)
+        self.like(self.users[2], book_0)
+        self.like(self.users[2], book_3)
+
+        UserBookRelation.objects.get(user=self.users[2],
+                                     book=book_3).delete()
+        self.users[1].delete()
+        incremental = self.get_pairs()
+        compute_similarities(top_k=10)
+        self.assertEqual(self.get_pairs(), incremental)
+        self.assertEqual(1, incremental[book_0.id, book_1.id])
+        self.assertNotIn((book_0.id, book_3.id), incremental)
+        response = self.client.get(reverse('book-similar',
+                                           args=(book_3.id,)))
+        self.assertEqual([], response.data)
+
+    def test_compute_overwrites(self):
+        """Пара, вставленная лайком между DELETE и INSERT пересчета, не
+        роняет пересчет"""
+        book_0, book_1 = self.books[:2]
+        for book in (book_0, book_1):
+            UserBookRelation.objects.create(user=self.users[0], book=book,
+                                            like=True)
+        BookSimilarity.objects.filter(book=book_0).update(co_count=5)
+        with mock.patch('django.db.models.query.QuerySet.delete'):
+            compute_similarities()
+        self.assertEqual({(book_0.id, book_1.id): 1,
+                          (book_1.id, book_0.id): 1}, self.get_pairs())
+
+    def test_incremental_top_k(self):
+        """Между пересчетами у книги не больше top_k соседей, записанные
+        пары продолжают считаться"""
+        book_0, book_1, book_2, book_3 = self.books
+        UserBookRelation.objects.bulk_create(
+            UserBookRelation(user=user, book=book, like=True)
+            for user in self.users[:2] for book in (book_0, book_1)
+        )
+        record_like_changes(self.users[0].id, added=[book_0.id, book_1.id],
+                            top_k=1)
+        UserBookRelation.objects.bulk_create([
+            UserBookRelation(user=self.users[1], book=book_2, like=True)
+        ])
+        record_like_changes(self.users[1].id, added=[book_0.id, book_1.id,
+                                                     book_2.id], top_k=1)
+        self.assertEqual({
+            (book_0.id, book_1.id): 2,
+            (book_1.id, book_0.id): 2,
+            (book_2.id, book_0.id): 1,
+        }, self.get_pairs())
+
+    def test_many_likes(self):
+        """Лайк пользователя с сотнями лайков: условия по спискам книг, а не
+        по одному на пару"""
+        books = Book.objects.bulk_create(
+            Book(name=f'Book {number}', price=1000, author_name='Author 1')
+            for number in range(700)
+        )
+        UserBookRelation.objects.bulk_create(
+            UserBookRelation(user=self.users[0], book=book, like=True)
+            for book in books
+        )
+        self.like(self.users[0], self.books[0])
+        self.assertEqual(DEFAULT_TOP_K, BookSimilarity.objects.filter(
+            book=self.books[0]).count())
+        self.like(self.users[0], self.books[0], like=False)
+
+    def test_similar(self):
+        book_0, book_1, book_2, book_3 = self.books
+        for user in self.users:
+            self.like(user, book_0)
+            self.like(user, book_2)
+        self.like(self.users[0], book_1)
+        self.client.logout()
+
+        url = reverse('book-similar', args=(book_0.id,))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(1, len(queries))
+        self.assertEqual([book_2.id, book_1.id],
+                         [book['id'] for book in response.data])
+        self.assertNotIn('readers', response.data[0])
+
+        response = self.client.get(url, data={'limit': 1})
+        self.assertEqual([book_2.id], [book['id'] for book in response.data])
+        response = self.client.get(reverse('book-similar',
+                                           args=(book_3.id,)))
+        self.assertEqual([], response.data)
+        response = self.client.get(reverse('book-similar',
+                                           args=(book_3.id + 100,)))
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
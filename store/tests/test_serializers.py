@@ -1,7 +1,10 @@
+from collections import defaultdict
+
 from django.contrib.auth.models import User
-from django.db.models import Count, Case, When, Avg
 from django.test import TestCase
+from rest_framework.renderers import JSONRenderer
 
+from store.compiled import CompiledRepresentation
 from store.models import Book, UserBookRelation
 from store.serializers import BookSerializer
 
@@ -51,12 +54,7 @@ class BookSerializerTestCase(TestCase):
                                         rate=4)
         UserBookRelation.objects.create(user=user_3, book=book_2, like=False)
 
-        books = Book.objects.all().annotate(
-            annotated_likes=Count(Case(When(
-                userbookrelation__like=True,
-                then=1
-            )))
-        ).order_by('id')
+        books = Book.objects.all().order_by('id')
         data = BookSerializer(books, many=True).data
         expected_data = [
             {
@@ -107,3 +105,77 @@ class BookSerializerTestCase(TestCase):
             }
         ]
         self.assertEqual(expected_data, data)
+
+
+class CompiledRepresentationTestCase(TestCase):
+    def test_same_output(self):
+        user_1 = User.objects.create(username='user_1',
+                                     first_name='first_name_1',
+                                     last_name='last_name_1')
+        user_2 = User.objects.create(username='user_2')
+        book_1 = Book.objects.create(name='Test book 1', price='10.5',
+                                     author_name='Author 1', owner=user_1)
+        book_2 = Book.objects.create(name='Test book 2', price=2000,
+                                     author_name='Author 2')
+        Book.objects.create(name='Test book 3', price=0,
+                            author_name='Author 3', owner=user_2)
+        UserBookRelation.objects.create(user=user_1, book=book_1, like=True,
+                                        rate=5)
+        UserBookRelation.objects.create(user=user_2, book=book_1, rate=2)
+        UserBookRelation.objects.create(user=user_1, book=book_2, like=True)
+
+        compiled = CompiledRepresentation(BookSerializer)
+        self.assertEqual(['id', 'name', 'price', 'author_name', 'likes_count',
+                          'rating', 'owner__username'],
+                         compiled.value_fields)
+        readers = defaultdict(list)
+        for relation in UserBookRelation.objects.order_by('id').values(
+                'book_id', 'user__first_name', 'user__last_name'):
+            readers[relation['book_id']].append({
+                'first_name': relation['user__first_name'],
+                'last_name': relation['user__last_name'],
+            })
+        rows = Book.objects.order_by('id').values(*compiled.value_fields)
+        for row in rows:
+            row['readers'] = readers[row['id']]
+
+        books = Book.objects.order_by('id').prefetch_related('readers')
+        renderer = JSONRenderer()
+        self.assertEqual(
+            renderer.render(BookSerializer(books, many=True).data),
+            renderer.render(compiled.many(rows))
+        )
+
+    def test_expand(self):
+        book = Book.objects.create(name='Test book 1', price=1000,
+                                   author_name='Author 1')
+        user = User.objects.create(username='user_1')
+        UserBookRelation.objects.create(user=user, book=book, rate=4)
+
+        expand = frozenset({'rating_histogram'})
+        compiled = CompiledRepresentation(BookSerializer, expand)
+        row = Book.objects.values(*compiled.value_fields).get()
+        row['readers'] = [{'first_name': '', 'last_name': ''}]
+        book = Book.objects.prefetch_related('readers').get()
+        self.assertEqual(
+            BookSerializer(book, context={'expand': expand}).data,
+            compiled(row)
+        )
+        self.assertEqual([0, 0, 0, 1, 0], compiled(row)['rating_histogram'])
+        self.assertNotIn('rating_histogram', BookSerializer(book).data)
+
+    def test_sparse_fields(self):
+        Book.objects.create(name='Test book 1', price=1000,
+                            author_name='Author 1')
+        fields = frozenset({'name', 'price'})
+        compiled = CompiledRepresentation(BookSerializer, fields=fields)
+        self.assertEqual(['name', 'price'], compiled.value_fields)
+        self.assertEqual({}, compiled.nested)
+        row = Book.objects.values(*compiled.value_fields).get()
+        book = Book.objects.get()
+        self.assertEqual(
+            BookSerializer(book, context={'fields': fields}).data,
+            compiled(row)
+        )
+        self.assertEqual({'name': 'Test book 1', 'price': '1000.00'},
+                         compiled(row))
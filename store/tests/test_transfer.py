@@ -0,0 +1,104 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from store.models import Book, UserBookRelation
+from store.transfer import BookImportError, import_books
+
+
+class ImportBooksTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='publisher')
+
+    def test_csv(self):
+        lines = [
+            'name,price,author_name,owner\n',
+            'Book 1,10.50,Author 1,publisher\n',
+            'Book 2,20,Author 2,\n',
+            'Book 3,30,Author 3,publisher\n',
+        ]
+        self.assertEqual(3, import_books(lines, 'csv', batch_size=2))
+        books = Book.objects.order_by('name')
+        self.assertEqual(['Book 1', 'Book 2', 'Book 3'],
+                         [book.name for book in books])
+        self.assertEqual([self.user.id, None, self.user.id],
+                         [book.owner_id for book in books])
+
+    def test_errors(self):
+        lines = [
+            '{"name": "Book 1", "price": "10", "author_name": "A"}\n',
+            '{"name": "Book 2", "price": "abc", "author_name": "A"}\n',
+        ]
+        with self.assertRaisesMessage(BookImportError, 'line 2: price'):
+            import_books(lines, 'ndjson')
+        lines = ['{"name": "B", "price": 1, "author_name": "A", '
+                 '"owner": "nobody"}\n']
+        with self.assertRaisesMessage(BookImportError, 'unknown user'):
+            import_books(lines, 'ndjson')
+        self.assertFalse(Book.objects.exists())
+
+
+class TransferApiTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='staff', is_staff=True)
+        self.book = Book.objects.create(name='Test book 1', price=25,
+                                        author_name='Author 1',
+                                        owner=self.user)
+        UserBookRelation.objects.create(user=self.user, book=self.book,
+                                        like=True, rate=4)
+
+    def test_export(self):
+        url = reverse('book-export')
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([
+            'id,name,price,author_name,owner,rating,likes_count',
+            f'{self.book.id},Test book 1,25.00,Author 1,staff,4.00,1',
+        ], b''.join(response.streaming_content).decode().splitlines())
+
+        response = self.client.get(url, data={'output': 'ndjson'})
+        rows = [json.loads(line) for line in
+                b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual('4.00', rows[0]['rating'])
+        self.assertEqual(1, rows[0]['likes_count'])
+
+    def test_import(self):
+        url = reverse('book-import')
+        data = 'name,price,author_name\nImported,99.99,Author 2\n'
+        response = self.client.post(url, data=data, content_type='text/csv')
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+        self.client.force_login(self.user)
+        response = self.client.post(url, data=data, content_type='text/csv')
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual({'created': 1}, response.data)
+        book = Book.objects.get(name='Imported')
+        self.assertEqual(self.user, book.owner)
+
+        response = self.client.post(url, data='name,price\nX,1\n',
+                                    content_type='text/csv')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        # Пустое тело: request.stream - None
+        response = self.client.post(url, data='',
+                                    content_type='application/x-ndjson')
+        self.assertEqual({'created': 0}, response.data)
+
+    def test_commands_roundtrip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'books.ndjson')
+            call_command('export_books', path, '--output', 'ndjson')
+            Book.objects.all().delete()
+            out = StringIO()
+            call_command('import_books', path, stdout=out)
+        self.assertEqual('Imported 1 book(s)\n', out.getvalue())
+        book = Book.objects.get()
+        self.assertEqual('Test book 1', book.name)
+        self.assertEqual(self.user, book.owner)
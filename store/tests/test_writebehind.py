@@ -0,0 +1,207 @@
+import json
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import override_settings, TransactionTestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from store.models import Book, UserBookRelation
+from store.writebehind import WriteBehindBuffer, get_write_behind, \
+    reset_write_behind
+
+
+class WriteBehindApiTestCase(APITestCase):
+    def setUp(self):
+        # Настройка на каждый тест, а не на класс: новый буфер на тест
+        settings_override = override_settings(
+            BOOKS_WRITE_BEHIND={'FLUSH_INTERVAL': None, 'MAX_PENDING': 100}
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create(username='test_username')
+        self.user_2 = User.objects.create(username='test_username_2')
+        self.book = Book.objects.create(name='Test book 1', price=1000,
+                                        author_name='Author 1')
+        self.url = reverse('userbookrelation-detail', args=(self.book.id,))
+
+    def patch(self, user, data):
+        self.client.force_login(user)
+        return self.client.patch(self.url, data=json.dumps(data),
+                                 content_type='application/json')
+
+    def test_buffered(self):
+        response = self.patch(self.user, {'like': True})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        response = self.patch(self.user, {'in_bookmarks': True, 'rate': 4})
+        # Ответ уже с изменениями, в БД их еще нет
+        self.assertEqual({'book': self.book.id, 'like': True,
+                          'in_bookmarks': True, 'rate': 4}, response.data)
+        self.assertFalse(UserBookRelation.objects.exists())
+
+        self.assertEqual(1, get_write_behind().flush())
+        relation = UserBookRelation.objects.get(user=self.user,
+                                                book=self.book)
+        self.assertTrue(relation.like)
+        self.assertTrue(relation.in_bookmarks)
+        self.assertEqual(4, relation.rate)
+        self.book.refresh_from_db()
+        self.assertEqual(1, self.book.likes_count)
+        self.assertEqual('4.00', str(self.book.rating))
+
+    def test_coalesced(self):
+        UserBookRelation.objects.create(user=self.user_2, book=self.book,
+                                        like=True)
+        self.book.refresh_from_db()
+        self.assertEqual(1, self.book.likes_count)
+        for like in (True, False, True):
+            self.patch(self.user, {'like': like})
+        self.patch(self.user_2, {'like': False})
+
+        self.assertEqual(2, get_write_behind().flush())
+        self.book.refresh_from_db()
+        self.assertEqual(1, self.book.likes_count)
+        self.assertEqual(
+            {(self.user.id, True), (self.user_2.id, False)},
+            set(UserBookRelation.objects.values_list('user_id', 'like'))
+        )
+
+    def test_book_not_found(self):
+        url = reverse('userbookrelation-detail', args=(self.book.id + 100,))
+        self.client.force_login(self.user)
+        response = self.client.patch(url, data=json.dumps({'like': True}),
+                                     content_type='application/json')
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+        self.assertEqual(0, get_write_behind().flush())
+
+    def test_deleted_book_dropped(self):
+        book_2 = Book.objects.create(name='Test book 2', price=1000,
+                                     author_name='Author 1')
+        self.client.force_login(self.user)
+        self.client.patch(
+            reverse('userbookrelation-detail', args=(book_2.id,)),
+            data=json.dumps({'like': True}), content_type='application/json'
+        )
+        self.patch(self.user_2, {'like': True})
+        book_2.delete()
+
+        with self.assertLogs('store.writebehind', 'WARNING'):
+            self.assertEqual(1, get_write_behind().flush())
+        # Изменения другой книги записаны, буфер пуст
+        self.assertEqual(
+            [(self.user_2.id, self.book.id)],
+            list(UserBookRelation.objects.values_list('user_id', 'book_id'))
+        )
+        self.assertEqual(0, get_write_behind().flush())
+
+    def test_bulk_flushes_user(self):
+        self.patch(self.user, {'like': True, 'rate': 2})
+        self.patch(self.user_2, {'like': True})
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse('userbookrelation-bulk'),
+            data=json.dumps([{'book': self.book.id, 'rate': 5}]),
+            content_type='application/json'
+        )
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        relation = UserBookRelation.objects.get(user=self.user,
+                                                book=self.book)
+        self.assertTrue(relation.like)
+        self.assertEqual(5, relation.rate)
+        # Изменения другого пользователя остались в буфере
+        self.assertFalse(UserBookRelation.objects.filter(
+            user=self.user_2).exists())
+        self.assertEqual({'like': True},
+                         get_write_behind().overlay(self.user_2.id,
+                                                    self.book.id))
+
+    def test_created_once(self):
+        """Параллельные первые запросы получают один буфер"""
+        created = []
+
+        def slow_init(buffer, **kwargs):
+            created.append(buffer)
+            time.sleep(0.05)
+
+        with mock.patch.object(WriteBehindBuffer, '__init__', slow_init), \
+                mock.patch.object(WriteBehindBuffer, 'stop'):
+            threads = [threading.Thread(target=get_write_behind)
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(1, len(created))
+            self.assertIs(created[0], get_write_behind())
+            reset_write_behind('BOOKS_WRITE_BEHIND')
+
+
+class WriteBehindFailureTestCase(TransactionTestCase):
+    """Без транзакции теста: внешние ключи проверяются при COMMIT"""
+
+    def test_failed_pair_dropped(self):
+        user = User.objects.create(username='test_username')
+        books = [Book.objects.create(name=f'Test book {number}', price=1000,
+                                     author_name='Author 1')
+                 for number in range(2)]
+        buffer = WriteBehindBuffer(flush_interval=None)
+        self.addCleanup(buffer.stop)
+        for book in books:
+            buffer.add(user.id, book.id, {'like': True})
+        books[0].delete()
+        # Книгу удалили после проверки пачки
+        with mock.patch.object(WriteBehindBuffer, '_drop_missing',
+                               lambda self, batch: batch), \
+                self.assertLogs('store.writebehind', 'ERROR'):
+            self.assertEqual(1, buffer.flush())
+        self.assertEqual(
+            [books[1].id],
+            list(UserBookRelation.objects.values_list('book_id', flat=True))
+        )
+        self.assertEqual(0, buffer.flush())
+
+
+class WriteBehindJournalTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book = Book.objects.create(name='Test book 1', price=1000,
+                                        author_name='Author 1')
+        journal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(journal_dir.cleanup)
+        self.journal_dir = journal_dir.name
+
+    def test_replay(self):
+        crashed = WriteBehindBuffer(flush_interval=None,
+                                    journal_dir=self.journal_dir)
+        crashed.add(self.user.id, self.book.id, {'like': True})
+        crashed.add(self.user.id, self.book.id, {'rate': 3})
+        # Процесс упал: буфер не сброшен, блокировка журнала снята
+        crashed.stop()
+        crashed._journal.close()
+
+        buffer = WriteBehindBuffer(flush_interval=None,
+                                   journal_dir=self.journal_dir)
+        self.addCleanup(buffer.close)
+        relation = UserBookRelation.objects.get(user=self.user,
+                                                book=self.book)
+        self.assertTrue(relation.like)
+        self.assertEqual(3, relation.rate)
+        # Журнал упавшего процесса удален, журнал живого - пропущен
+        self.assertEqual(0, buffer.replay_journals())
+
+    def test_journal_rewritten_after_flush(self):
+        buffer = WriteBehindBuffer(flush_interval=None, max_pending=2,
+                                   journal_dir=self.journal_dir)
+        self.addCleanup(buffer.close)
+        buffer.add(self.user.id, self.book.id, {'like': True})
+        with open(buffer._journal.name) as journal:
+            self.assertEqual(1, len(journal.readlines()))
+        # max_pending пар - сброс сразу
+        user_2 = User.objects.create(username='test_username_2')
+        buffer.add(user_2.id, self.book.id, {'like': True})
+        with open(buffer._journal.name) as journal:
+            self.assertEqual('', journal.read())
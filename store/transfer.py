@@ -0,0 +1,180 @@
+import csv
+import json
+from decimal import Decimal
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from store.cache import invalidate_books
+from store.models import Book
+from store.search import update_search_index
+
+# Импорт и экспорт каталога книг в CSV и NDJSON (по объекту JSON в строке).
+# Все функции работают с итераторами строк и не держат в памяти больше
+# одной пачки книг.
+INPUT_FIELDS = ('name', 'price', 'author_name', 'owner')
+EXPORT_FIELDS = ('id', 'name', 'price', 'author_name', 'owner', 'rating',
+                 'likes_count')
+FORMATS = ('csv', 'ndjson')
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class BookImportError(ValueError):
+    """Ошибка в строке импортируемого файла"""
+
+    def __init__(self, line, detail):
+        super().__init__(f'line {line}: {detail}')
+        self.line = line
+        self.detail = detail
+
+
+def read_csv(lines):
+    """Строки CSV с заголовком -> (номер строки, словарь)"""
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_ndjson(lines):
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            raise BookImportError(number, f'invalid JSON: {exc}')
+        if not isinstance(row, dict):
+            raise BookImportError(number, 'expected a JSON object')
+        yield number, row
+
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+}
+
+
+class OwnerCache:
+    """username -> id пользователя. Неизвестные имена пачки загружаются
+    одним запросом, найденные запоминаются на весь импорт"""
+
+    def __init__(self):
+        self.ids = {}
+
+    def load(self, usernames):
+        missing = set(usernames) - set(self.ids)
+        if missing:
+            self.ids.update(User.objects.filter(
+                username__in=missing).values_list('username', 'id'))
+
+    def get(self, username):
+        return self.ids.get(username)
+
+
+def clean_row(row, line):
+    """Проверяет поля строки валидаторами полей модели (без
+    сериализатора) и возвращает {name, price, author_name, owner}"""
+    data = {}
+    for name in ('name', 'price', 'author_name'):
+        field = Book._meta.get_field(name)
+        value = row.get(name)
+        if isinstance(value, str):
+            value = value.strip()
+        try:
+            data[name] = field.clean(value, None)
+        except ValidationError as exc:
+            raise BookImportError(line, f'{name}: {" ".join(exc.messages)}')
+    owner = row.get('owner')
+    data['owner'] = owner.strip() if isinstance(owner, str) else owner
+    return data
+
+
+def import_books(lines, input_format='csv', batch_size=500, owner=None,
+                 using='default'):
+    """Импортирует книги из итератора строк пачками по batch_size через
+    bulk_create, все в одной транзакции: ошибка в любой строке отменяет
+    импорт целиком (BookImportError с номером строки).
+
+    owner - пользователь для строк без колонки owner. Возвращает число
+    созданных книг."""
+    rows = READERS[input_format](lines)
+    owners = OwnerCache()
+    created = 0
+    with transaction.atomic(using=using):
+        while True:
+            batch = [(line, clean_row(row, line))
+                     for line, row in islice(rows, batch_size)]
+            if not batch:
+                break
+            owners.load(data['owner'] for _, data in batch if data['owner'])
+            books = []
+            for line, data in batch:
+                username = data.pop('owner')
+                if username:
+                    owner_id = owners.get(username)
+                    if owner_id is None:
+                        raise BookImportError(
+                            line, f'owner: unknown user "{username}"')
+                else:
+                    owner_id = owner.pk if owner else None
+                books.append(Book(owner_id=owner_id, **data))
+            Book.objects.using(using).bulk_create(books)
+            # bulk_create не вызывает сигналы: FTS таблицу SQLite
+            # обновляем сами (в PostgreSQL это делает триггер)
+            update_search_index(books, using=using)
+            created += len(books)
+        if created:
+            invalidate_books()
+    return created
+
+
+def export_rows(queryset, chunk_size=2000):
+    """Кортежи EXPORT_FIELDS по серверному курсору, без загрузки всего
+    queryset в память"""
+    return queryset.order_by('id').values_list(
+        'id', 'name', 'price', 'author_name', 'owner__username', 'rating',
+        'likes_count'
+    ).iterator(chunk_size=chunk_size)
+
+
+class _Echo:
+    """Файл для csv.writer, который просто возвращает записанную строку"""
+
+    def write(self, value):
+        return value
+
+
+def write_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _json_default(value):
+    # Decimal отдаем строкой, как DRF (COERCE_DECIMAL_TO_STRING)
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def write_ndjson(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False,
+                         default=_json_default) + '\n'
+
+
+WRITERS = {
+    'csv': write_csv,
+    'ndjson': write_ndjson,
+}
+
+
+def export_books(queryset, output_format='csv', chunk_size=2000):
+    """Генератор строк экспорта каталога в формате output_format"""
+    return WRITERS[output_format](export_rows(queryset, chunk_size))
@@ -1,44 +1,470 @@
-from django.db.models import Count, Case, When, Avg
+from hashlib import sha1
+
+from django.db import connection
+from django.db.models import F, prefetch_related_objects
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework import status
+from rest_framework.decorators import action, api_view, \
+    permission_classes
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.filters import OrderingFilter
 from rest_framework.mixins import UpdateModelMixin
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated, \
+    SAFE_METHODS
+from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 
+from store.cache import entry_response, get_response_cache, \
+    ResponseCache, set_validators
+from store.compiled import get_compiled_representation
+from store.logic import attach_readers_values, bulk_upsert_relations, \
+    prefetch_readers_preview, upsert_relation
+from store.metrics import registry
 from store.models import Book, UserBookRelation
+from store.pagination import RelationKeysetPagination
+from store.recommendations import similar_books
 from store.permissions import IsOwnerOrStaffOrReadOnly
-from store.serializers import BookSerializer, UserBooksRelationSerializer
+from store.renderers import StreamingJSONRenderer, chunked
+from store.search import BookSearchFilter
+from store.serializers import BookFeedSerializer, BookSerializer, \
+    BookSummarySerializer, UserBooksRelationSerializer, BookPreviewSerializer
+from store.transfer import BookImportError, CONTENT_TYPES, FORMATS, \
+    export_books, import_books
+from store.writebehind import flush_user_changes, get_write_behind
 
 
 class BookViewSet(ModelViewSet):
-    queryset = Book.objects.all().annotate(
-            annotated_likes=Count(Case(When(
-                userbookrelation__like=True,
-                then=1
-            )))
-            # rating=Avg('userbookrelation__rate')
-        ).select_related('owner').prefetch_related(
+    # Лайки и рейтинг хранятся в самой книге (likes_count, rating), поэтому
+    # здесь нет JOIN + GROUP BY по UserBookRelation
+    queryset = Book.objects.all().select_related('owner').prefetch_related(
         'readers').order_by('id')
     serializer_class = BookSerializer
     # DjangoFilterBackend - фильтрация в url /?field=значение
-    # SearchFilter Чтоб искать по двум и более полям .../?search=фраза
+    # BookSearchFilter Чтоб искать по двум и более полям .../?search=фраза
+    # (по полнотекстовому индексу, см. store/search.py)
     # OrderingFilter - для сортировки .../?ordering=price .../?ordering=-price
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, BookSearchFilter, OrderingFilter]
     # IsAuthenticated, IsAuthenticatedOrReadOnly - из DRF
     # IsOwnerOrReadOnly - свое разрешение
     permission_classes = [IsOwnerOrStaffOrReadOnly]
-    filter_fields = ['price']
-    # Потому, что SearchFilter, укажем поля по которым сможем искать
+    # filterset_fields - имя из django-filter 2.x; старое filter_fields в
+    # 21.1 еще работает, но с предупреждением об устаревании
+    filterset_fields = ['price']
+    # Поля поиска, если индекса нет и BookSearchFilter работает как обычный
+    # SearchFilter
     search_fields = ['name', 'author_name']
     # Потому, что OrderingFilter, укажем по каким полям можем сортировать
     ordering_fields = ['price', 'author_name']
+    # ?readers_limit=N - вместо всех читателей книги отдать первых N и
+    # readers_count (не больше max_readers_limit)
+    readers_limit_query_param = 'readers_limit'
+    max_readers_limit = 50
+    # ?expand=имя,... - необязательные поля сериализатора
+    # (Meta.expandable_fields), например rating_histogram
+    expand_query_param = 'expand'
+    # ?fields=имя,... - вывести только эти поля книги. Запрос строится по
+    # ним же: без owner_name нет JOIN пользователей, без readers - запроса
+    # читателей
+    fields_query_param = 'fields'
+    # Размер пачки книг в /book/stream/
+    stream_chunk_size = 500
+    # Лидерборды: сортировка и условие. ?limit=N - размер (не больше
+    # max_leaderboard_limit), ?author=имя - только книги автора
+    leaderboards = {
+        'top_rated': (('-rating', 'id'), {'rating__isnull': False}),
+        'most_liked': (('-likes_count', 'id'), {'likes_count__gt': 0}),
+    }
+    leaderboard_limit = 10
+    max_leaderboard_limit = 100
+    # Действия, отдающие книги без читателей (BookSummarySerializer)
+    summary_actions = ('top_rated', 'most_liked', 'similar')
+
+    def get_expand(self):
+        """frozenset запрошенных необязательных полей"""
+        value = self.request.query_params.get(self.expand_query_param, '')
+        expand = frozenset(name for name in value.split(',') if name)
+        unknown = expand - set(getattr(self.get_serializer_class().Meta,
+                                       'expandable_fields', ()))
+        if unknown:
+            raise ValidationError({
+                self.expand_query_param:
+                    f'Неизвестные поля: {", ".join(sorted(unknown))}.'
+            })
+        return expand
+
+    def get_sparse_fields(self):
+        """frozenset полей из ?fields= или None - все поля. Только для
+        чтения: запись принимает и возвращает книгу целиком"""
+        if self.request.method not in SAFE_METHODS:
+            return None
+        value = self.request.query_params.get(self.fields_query_param)
+        if value is None:
+            return None
+        fields = frozenset(name for name in value.split(',') if name)
+        unknown = fields - set(self.get_serializer_class().Meta.fields)
+        if not fields or unknown:
+            raise ValidationError({
+                self.fields_query_param:
+                    f'Неизвестные поля: {", ".join(sorted(unknown))}.'
+                    if unknown else 'Ожидается список полей.'
+            })
+        return fields
+
+    def includes_field(self, name):
+        """Будет ли поле name в ответе (с учетом ?fields=)"""
+        fields = self.get_sparse_fields()
+        return fields is None or name in fields
+
+    def needs_readers_preview(self):
+        return self.includes_field('readers') or \
+            self.includes_field('readers_count')
+
+    def get_ordering_columns(self):
+        """Колонки сортировки запроса (?ordering=): нужны курсору
+        пагинации, даже если их нет среди выводимых полей"""
+        ordering = OrderingFilter().get_ordering(
+            self.request, self.queryset, self) or ()
+        return [field.lstrip('-') for field in ordering]
+
+    def get_only_fields(self):
+        """Колонки для .only() при ?fields=: источники выводимых полей,
+        id и колонки сортировки"""
+        names = []
+        for name in self.get_compiled(BookSerializer).value_fields:
+            if '__' in name:
+                # owner__username: сам внешний ключ тоже нужен для JOIN
+                names.append(name.split('__')[0])
+            names.append(name)
+        return list(dict.fromkeys(
+            [*names, 'id', *self.get_ordering_columns()]
+        ))
+
+    def get_compiled(self, serializer_class):
+        """Скомпилированный serializer_class с ?expand= и ?fields="""
+        return get_compiled_representation(
+            serializer_class, self.get_expand(), self.get_sparse_fields()
+        )
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['expand'] = self.get_expand()
+        context['fields'] = self.get_sparse_fields()
+        return context
+
+    def get_readers_limit(self):
+        if self.action not in ('list', 'retrieve', 'stream'):
+            return None
+        value = self.request.query_params.get(self.readers_limit_query_param)
+        if value is None:
+            return None
+        try:
+            limit = int(value)
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= self.max_readers_limit:
+            raise ValidationError({
+                self.readers_limit_query_param:
+                    f'Ожидается число от 1 до {self.max_readers_limit}.'
+            })
+        return limit
+
+    def use_values(self):
+        """Список с обычным BookSerializer читается через .values(): только
+        сериализуемые колонки, без экземпляров Book и User"""
+        return self.action == 'list' and \
+            self.get_serializer_class() is BookSerializer
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.use_values():
+            # Колонки только выводимых полей, плюс id (читатели, курсор) и
+            # поля ?ordering= для курсора пагинации. Аннотации фильтров
+            # (search_rank) добавятся к словарям сами
+            value_fields = dict.fromkeys([
+                *self.get_compiled(BookSerializer).value_fields,
+                'id', *self.get_ordering_columns()
+            ])
+            return queryset.select_related(None).prefetch_related(
+                None).values(*value_fields)
+        if self.get_readers_limit() is not None or \
+                not self.includes_field('readers'):
+            # Читателей подтянет prefetch_readers_preview (или они не
+            # нужны), полный prefetch не нужен
+            queryset = queryset.prefetch_related(None)
+        if not self.includes_field('owner_name'):
+            queryset = queryset.select_related(None)
+        if self.action in ('list', 'retrieve', 'stream') and \
+                self.get_sparse_fields() is not None:
+            queryset = queryset.only(*self.get_only_fields())
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action in self.summary_actions:
+            return BookSummarySerializer
+        if self.get_readers_limit() is not None:
+            return BookPreviewSerializer
+        return super().get_serializer_class()
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        limit = self.get_readers_limit()
+        if page is not None and limit is not None and \
+                self.needs_readers_preview():
+            prefetch_readers_preview(page, limit)
+        return page
+
+    def get_object(self):
+        book = super().get_object()
+        limit = self.get_readers_limit()
+        if limit is not None and self.needs_readers_preview():
+            prefetch_readers_preview([book], limit)
+        return book
+
+    def list(self, request, *args, **kwargs):
+        return self.cached(
+            lambda cache: cache.list_key(request.query_params),
+            self.list_values if self.use_values() else super().list,
+            request, *args, **kwargs
+        )
+
+    def list_values(self, request, *args, **kwargs):
+        """list() по строкам .values(): читатели страницы одним узким JOIN,
+        вывод - скомпилированным BookSerializer (тот же JSON)"""
+        compiled = self.get_compiled(BookSerializer)
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        rows = page if page is not None else list(queryset)
+        if 'readers' in compiled.nested:
+            attach_readers_values(rows,
+                                  compiled.nested['readers'].value_fields)
+        data = compiled.many(rows)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached(
+            lambda cache: cache.detail_key(self.get_book_id(),
+                                           request.query_params),
+            super().retrieve, request, *args, **kwargs
+        )
+
+    def get_book_id(self):
+        """id книги из адреса; не число - 404, как у get_object"""
+        try:
+            return int(self.kwargs[self.lookup_field])
+        except ValueError:
+            raise NotFound
+
+    def get_version(self):
+        """Дешевая версия ответа без основного запроса. Для книги - ее
+        updated_at (запрос по первичному ключу), для списков - версия
+        списка в кэше ответов, которую поднимает каждая запись, без
+        запросов к БД. Версии в памяти процесса (LocMemLRUBackend) не видят
+        записей других процессов, поэтому без общего кэша ответов у списков
+        нет валидаторов. Возвращает (версия, время изменения)."""
+        if not self.detail:
+            response_cache = get_response_cache()
+            if response_cache is None or not response_cache.backend.shared:
+                return None, None
+            return f'list:{response_cache.list_version()}', None
+        book_id = self.get_book_id()
+        last_modified = Book.objects.filter(pk=book_id).values_list(
+            'updated_at', flat=True).first()
+        if last_modified is None:
+            return None, None
+        return f'{book_id}:{last_modified}', last_modified
+
+    def get_validators(self, request):
+        """(ETag, Last-Modified как timestamp) для текущего запроса или
+        (None, None), если книги нет или версию не узнать"""
+        version, last_modified = self.get_version()
+        if version is None:
+            return None, None
+        query = ResponseCache.normalize_query(request.query_params)
+        etag = quote_etag(sha1(f'{version}:{query}'.encode()).hexdigest())
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        return etag, timestamp
+
+    def cached(self, make_key, handler, request, *args, **kwargs):
+        """Отдает ответ из кэша или вызывает handler. Для условных запросов
+        (If-None-Match/If-Modified-Since) отвечает 304, не выполняя
+        queryset и сериализацию: валидаторы берутся из записи кэша, а при
+        промахе - одним дешевым запросом (get_version)."""
+        response_cache = get_response_cache()
+        key = make_key(response_cache) if response_cache else None
+        entry = response_cache.get(key) if key else None
+        if entry is not None:
+            return entry_response(request, entry)
+
+        etag, timestamp = self.get_validators(request)
+        response = None
+        if etag is not None:
+            response = get_conditional_response(
+                request, etag=etag, last_modified=timestamp
+            )
+        if response is None:
+            response = handler(request, *args, **kwargs)
+            # Ответ сохранится в кэш после рендеринга
+            self.response_cache_entry = (key, etag, timestamp)
+        return set_validators(response, etag, timestamp)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args,
+                                             **kwargs)
+        key, etag, timestamp = getattr(self, 'response_cache_entry',
+                                       (None, None, None))
+        if key is not None and response.status_code == 200:
+            response.render()
+            get_response_cache().set(key, (response.content, etag,
+                                           timestamp))
+        return response
 
     # Чтобы записать поле модели owner при создании новой книги
     def perform_create(self, serializer):
         serializer.validated_data['owner'] = self.request.user
         serializer.save()
 
+    @action(detail=False, methods=['get'])
+    def top_rated(self, request):
+        return self.cached(
+            lambda cache: cache.leaderboard_key('top-rated',
+                                                request.query_params),
+            self.leaderboard, request, 'top_rated'
+        )
+
+    @action(detail=False, methods=['get'])
+    def most_liked(self, request):
+        return self.cached(
+            lambda cache: cache.leaderboard_key('most-liked',
+                                                request.query_params),
+            self.leaderboard, request, 'most_liked'
+        )
+
+    def get_top_limit(self):
+        """?limit=N лидербордов и похожих книг"""
+        value = self.request.query_params.get('limit',
+                                              self.leaderboard_limit)
+        try:
+            limit = int(value)
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= self.max_leaderboard_limit:
+            raise ValidationError({
+                'limit': f'Ожидается число от 1 до '
+                         f'{self.max_leaderboard_limit}.'
+            })
+        return limit
+
+    def leaderboard(self, request, name):
+        """Первые limit книг по сортировке leaderboards[name]: чтение
+        начала частичного индекса (для автора - его книг по индексу
+        author_name), без читателей"""
+        limit = self.get_top_limit()
+        ordering, condition = self.leaderboards[name]
+        queryset = Book.objects.filter(**condition)
+        author = request.query_params.get('author')
+        if author is not None:
+            queryset = queryset.filter(author_name=author)
+        compiled = self.get_compiled(self.get_serializer_class())
+        rows = queryset.order_by(*ordering).values(
+            *compiled.value_fields)[:limit]
+        return Response(compiled.many(rows))
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        """Книги, которые лайкали те же пользователи, что и эту (см.
+        store.recommendations): один запрос по индексу соседей книги"""
+        limit = self.get_top_limit()
+        try:
+            book_id = int(pk)
+        except ValueError:
+            raise NotFound
+        compiled = self.get_compiled(self.get_serializer_class())
+        rows = list(similar_books(book_id, compiled.value_fields)[:limit])
+        if not rows and not Book.objects.filter(pk=book_id).exists():
+            raise NotFound
+        return Response(compiled.many(rows))
+
+    @action(detail=False, methods=['get'])
+    def stream(self, request):
+        """Весь список книг (с фильтрами, поиском и сортировкой списка, но
+        без пагинации) потоком JSON: книги читаются серверным курсором и
+        сериализуются пачками по stream_chunk_size, читатели подтягиваются
+        отдельно для каждой пачки"""
+        queryset = self.filter_queryset(
+            self.get_queryset().prefetch_related(None)
+        )
+        limit = self.get_readers_limit()
+        if limit is None:
+            readers = self.includes_field('readers')
+        else:
+            readers = self.needs_readers_preview()
+        serializer_class = self.get_serializer_class()
+        context = self.get_serializer_context()
+
+        def chunks():
+            books = queryset.iterator(chunk_size=self.stream_chunk_size)
+            for chunk in chunked(books, self.stream_chunk_size):
+                if readers and limit is None:
+                    prefetch_related_objects(chunk, 'readers')
+                elif readers:
+                    prefetch_readers_preview(chunk, limit)
+                yield serializer_class(chunk, many=True,
+                                       context=context).data
+
+        return StreamingHttpResponse(
+            StreamingJSONRenderer().render_chunks(chunks()),
+            content_type='application/json'
+        )
+
+    def get_transfer_format(self, param, default=None):
+        value = self.request.query_params.get(param, default)
+        if value not in FORMATS:
+            raise ValidationError({param: f'Ожидается одно из: '
+                                          f'{", ".join(FORMATS)}.'})
+        return value
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Потоковый экспорт каталога: ?output=csv|ndjson (не ?format - его
+        занимает DRF под выбор рендерера). Фильтры и поиск списка
+        действуют и здесь."""
+        output_format = self.get_transfer_format('output', 'csv')
+        queryset = self.filter_queryset(Book.objects.all())
+        response = StreamingHttpResponse(
+            export_books(queryset, output_format),
+            content_type=CONTENT_TYPES[output_format]
+        )
+        response['Content-Disposition'] = \
+            f'attachment; filename="books.{output_format}"'
+        return response
+
+    @action(detail=False, methods=['post'], url_path='import',
+            url_name='import', permission_classes=[IsAdminUser])
+    def import_(self, request):
+        """Импорт каталога из тела запроса (text/csv или
+        application/x-ndjson). Тело читается построчно, без request.data."""
+        input_format = next(
+            (name for name, content_type in CONTENT_TYPES.items()
+             if request.content_type == content_type),
+            None
+        )
+        if input_format is None:
+            input_format = self.get_transfer_format('input')
+        # request.stream - тело без разбора парсерами (None, если тело
+        # пустое), читается построчно
+        lines = (line.decode('utf-8') for line in request.stream or ())
+        try:
+            created = import_books(lines, input_format, owner=request.user)
+        except (BookImportError, UnicodeDecodeError) as exc:
+            raise ValidationError({'detail': str(exc)})
+        return Response({'created': created}, status=status.HTTP_201_CREATED)
+
 
 class UserBooksRelationView(UpdateModelMixin, GenericViewSet):
     permission_classes = [IsAuthenticated]
@@ -46,14 +472,154 @@ class UserBooksRelationView(UpdateModelMixin, GenericViewSet):
     serializer_class = UserBooksRelationSerializer
     # Для того, чтобы не передавать id связи, а передавать id книги
     lookup_field = 'book'
+    # Максимум изменений в одном запросе bulk
+    max_bulk_size = 1000
+    # Условия на связь для лент пользователя (liked, bookmarked, rated)
+    feeds = {
+        'liked': {'like': True},
+        'bookmarked': {'in_bookmarks': True},
+        'rated': {'rate__isnull': False},
+    }
 
     def get_object(self):
-        obj, _ = UserBookRelation.objects.get_or_create(
-            user=self.request.user,
-            book_id=self.kwargs['book']  # Это book в lookup_field
-        )
+        try:
+            book_id = int(self.kwargs['book'])  # Это book в lookup_field
+        except ValueError:
+            raise NotFound
+        obj = UserBookRelation.objects.filter(
+            user=self.request.user, book_id=book_id
+        ).first()
+        if obj is None:
+            # Связь без книги не создаем
+            if not Book.objects.filter(pk=book_id).exists():
+                raise NotFound
+            obj, _ = UserBookRelation.objects.get_or_create(
+                user=self.request.user, book_id=book_id
+            )
         return obj
 
+    def update(self, request, *args, **kwargs):
+        write_behind = get_write_behind()
+        if write_behind is not None:
+            return self.update_later(write_behind, request, **kwargs)
+        # На PostgreSQL вместо get_or_create + save (4-6 запросов и гонка
+        # на создании) - один INSERT ... ON CONFLICT DO UPDATE
+        if connection.vendor != 'postgresql':
+            return super().update(request, *args, **kwargs)
+        partial = kwargs.pop('partial', False)
+        serializer = self.get_serializer(data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        changes = dict(serializer.validated_data)
+        changes.pop('book', None)
+        try:
+            relation = upsert_relation(request.user.id,
+                                       int(self.kwargs['book']), changes)
+        except (ValueError, Book.DoesNotExist):
+            raise NotFound
+        return Response(self.get_serializer(relation).data)
+
+    def update_later(self, write_behind, request, **kwargs):
+        """Изменение через буфер отложенной записи (BOOKS_WRITE_BEHIND):
+        в БД только чтение связи, ответ - связь с еще не записанными
+        изменениями пользователя"""
+        partial = kwargs.pop('partial', False)
+        serializer = self.get_serializer(data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        changes = dict(serializer.validated_data)
+        changes.pop('book', None)
+        try:
+            book_id = int(self.kwargs['book'])
+        except ValueError:
+            raise NotFound
+        relation = UserBookRelation.objects.filter(
+            user=request.user, book_id=book_id
+        ).first()
+        if relation is None:
+            if not Book.objects.filter(pk=book_id).exists():
+                raise NotFound
+            relation = UserBookRelation(user=request.user, book_id=book_id)
+        if changes:
+            write_behind.add(request.user.id, book_id, changes)
+        for name, value in write_behind.overlay(request.user.id,
+                                                book_id).items():
+            setattr(relation, name, value)
+        return Response(self.get_serializer(relation).data)
+
+    @action(detail=False, pagination_class=RelationKeysetPagination)
+    def liked(self, request):
+        return self.feed(request, 'liked')
+
+    @action(detail=False, pagination_class=RelationKeysetPagination)
+    def bookmarked(self, request):
+        return self.feed(request, 'bookmarked')
+
+    @action(detail=False, pagination_class=RelationKeysetPagination)
+    def rated(self, request):
+        return self.feed(request, 'rated')
+
+    def feed(self, request, name):
+        """Книги пользователя по условию feeds[name], новые связи первыми.
+        Один запрос: связи по частичному индексу (user, id) JOIN книга и
+        владелец, строки .values() и скомпилированный BookFeedSerializer, без
+        prefetch читателей"""
+        # Лента должна видеть отложенные изменения пользователя
+        flush_user_changes(request.user.id)
+        compiled = get_compiled_representation(BookFeedSerializer)
+        filters = {
+            f'userbookrelation__{lookup}': value
+            for lookup, value in self.feeds[name].items()
+        }
+        queryset = Book.objects.filter(
+            userbookrelation__user=request.user, **filters
+        ).annotate(
+            relation_id=F('userbookrelation__id'),
+            like=F('userbookrelation__like'),
+            in_bookmarks=F('userbookrelation__in_bookmarks'),
+            rate=F('userbookrelation__rate'),
+        ).values(*compiled.value_fields, 'relation_id')
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(compiled.many(page))
+
+    @action(detail=False, methods=['post', 'patch'])
+    def bulk(self, request):
+        """Список изменений [{book, like, in_bookmarks, rate}, ...] одним
+        запросом: вместо сотни PATCH по одной книге"""
+        if not isinstance(request.data, list):
+            raise ValidationError('Expected a list of items.')
+        if len(request.data) > self.max_bulk_size:
+            raise ValidationError(
+                f'Ensure this list has no more than {self.max_bulk_size} '
+                f'items.'
+            )
+        book_ids = set()
+        for item in request.data:
+            try:
+                book_ids.add(int(item['book']))
+            except (KeyError, TypeError, ValueError):
+                pass
+        context = self.get_serializer_context()
+        context['books'] = Book.objects.in_bulk(book_ids)
+        serializer = self.get_serializer_class()(
+            data=request.data, many=True, context=context
+        )
+        serializer.is_valid(raise_exception=True)
+        # Отложенные изменения тех же книг не должны перезаписать пачку
+        flush_user_changes(request.user.id)
+        relations = bulk_upsert_relations(request.user.id,
+                                          serializer.validated_data)
+        return Response(self.get_serializer(relations, many=True).data)
+
 
 def auth(request):
     return render(request, 'oauth.html')
+
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAdminUser])
+def metrics(request):
+    """Гистограммы PerformanceMiddleware этого процесса по маршрутам.
+    DELETE - сбросить"""
+    if request.method == 'DELETE':
+        registry.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    return Response(registry.snapshot())
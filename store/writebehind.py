@@ -0,0 +1,323 @@
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.contrib.auth.models import User
+from django.db import connections, DatabaseError, InterfaceError, \
+    OperationalError
+from django.dispatch import receiver
+
+from store.logic import apply_relation_changes
+from store.models import Book
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_PATTERN = 'writebehind-*.jsonl'
+
+
+class WriteBehindBuffer:
+    """Отложенная запись изменений связей пользователей с книгами.
+
+    PATCH /book_relation/{id}/ не пишет в БД, а кладет изменение в буфер
+    процесса. Изменения одной пары (user, book) сливаются: значения
+    абсолютные (like=True, rate=4), поэтому сто переключений лайка
+    превращаются в одну запись. Раз в flush_interval секунд (или сразу при
+    max_pending парах) фоновый поток применяет буфер одной транзакцией
+    apply_relation_changes: счетчики каждой книги меняются одним UPDATE на
+    сумму изменений всех пользователей, а не блокировкой строки горячей
+    книги на каждый лайк.
+
+    Сохранность: при нормальном завершении процесса буфер сбрасывается
+    (atexit). Если задан journal_dir, каждое изменение дописывается в
+    журнал процесса (JSON строки) до ответа клиенту; после сброса журнал
+    переписывается оставшимися изменениями. Журналы упавших процессов (их
+    flock никто не держит) применяются при старте буфера. Повторное
+    применение безопасно - значения абсолютные.
+    """
+
+    def __init__(self, flush_interval=1.0, max_pending=500, journal_dir=None):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.journal_dir = journal_dir
+        self._pending = OrderedDict()
+        # Пачка, которую сейчас применяет flush: видна в overlay
+        self._flushing = {}
+        self._lock = threading.Lock()
+        # Сбросы идут по одному, иначе более старая пачка могла бы
+        # примениться после более новой
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._journal = None
+        if journal_dir:
+            self.replay_journals()
+            self._journal = self._open_journal()
+        atexit.register(self.close)
+
+    def add(self, user_id, book_id, changes):
+        """Кладет изменения {поле: значение} пары в буфер"""
+        key = (user_id, book_id)
+        with self._lock:
+            self._pending.setdefault(key, {}).update(changes)
+            self._pending.move_to_end(key)
+            if self._journal is not None:
+                self._journal.write(self._journal_line(key, changes))
+                self._journal.flush()
+            full = len(self._pending) >= self.max_pending
+        if self.flush_interval is None:
+            if full:
+                self.flush()
+            return
+        self.start()
+        if full:
+            self._wakeup.set()
+
+    def overlay(self, user_id, book_id):
+        """Еще не записанные в БД изменения пары - для ответа тому же
+        пользователю (read-your-writes)"""
+        key = (user_id, book_id)
+        with self._lock:
+            return {**self._flushing.get(key, {}),
+                    **self._pending.get(key, {})}
+
+    def flush(self, user_id=None):
+        """Применяет буфер (или только изменения пользователя user_id).
+        Возвращает число примененных пар. При временной ошибке БД
+        (соединение, блокировки) изменения возвращаются в буфер; пары
+        удаленных книг и пользователей и пары, которые не применяются
+        из-за ограничений БД, пишутся в лог и отбрасываются - иначе одна
+        такая пара блокировала бы весь буфер"""
+        with self._flush_lock:
+            with self._lock:
+                if user_id is None:
+                    batch = dict(self._pending)
+                    self._pending.clear()
+                else:
+                    batch = {key: self._pending.pop(key)
+                             for key in list(self._pending)
+                             if key[0] == user_id}
+                self._flushing = batch
+            if not batch:
+                return 0
+            try:
+                applied = self._apply(batch)
+            except (InterfaceError, OperationalError):
+                with self._lock:
+                    for key, changes in batch.items():
+                        self._pending[key] = {**changes,
+                                              **self._pending.get(key, {})}
+                    self._flushing = {}
+                raise
+            with self._lock:
+                self._flushing = {}
+                self._rewrite_journal()
+            return applied
+
+    def _apply(self, batch):
+        batch = self._drop_missing(batch)
+        if not batch:
+            return 0
+        try:
+            apply_relation_changes(batch)
+            return len(batch)
+        except (InterfaceError, OperationalError):
+            raise
+        except DatabaseError:
+            # Например, книгу удалили уже после проверки: применяем пары
+            # по одной, чтобы остальные не пропали. Повтор безопасен -
+            # значения абсолютные
+            logger.exception('Write-behind batch failed, applying by pair')
+        applied = 0
+        for key, changes in batch.items():
+            try:
+                apply_relation_changes({key: changes})
+            except (InterfaceError, OperationalError):
+                raise
+            except DatabaseError:
+                logger.exception('Write-behind dropped %s: %s', key, changes)
+            else:
+                applied += 1
+        return applied
+
+    def _drop_missing(self, batch):
+        """Пачка без пар удаленных книг и пользователей"""
+        book_ids = set(Book.objects.filter(
+            pk__in={book_id for _, book_id in batch}
+        ).values_list('pk', flat=True))
+        user_ids = set(User.objects.filter(
+            pk__in={user_id for user_id, _ in batch}
+        ).values_list('pk', flat=True))
+        kept = {key: changes for key, changes in batch.items()
+                if key[0] in user_ids and key[1] in book_ids}
+        if len(kept) < len(batch):
+            logger.warning(
+                'Write-behind dropped changes of deleted books or users: %s',
+                {key: changes for key, changes in batch.items()
+                 if key not in kept}
+            )
+        return kept
+
+    def start(self):
+        """Запускает фоновый поток сброса (один раз)"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='store-write-behind', daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Останавливает фоновый поток без сброса буфера"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and \
+                self._thread is not threading.current_thread():
+            self._thread.join()
+        atexit.unregister(self.close)
+
+    def close(self):
+        """Останавливает поток и сбрасывает буфер (завершение процесса)"""
+        self.stop()
+        try:
+            self.flush()
+        except Exception:
+            # Изменения остались в журнале, их применит следующий процесс
+            logger.exception('Write-behind flush failed on shutdown')
+        if self._journal is not None:
+            if not self._pending:
+                os.unlink(self._journal.name)
+            self._journal.close()
+            self._journal = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Write-behind flush failed')
+            finally:
+                # Поток живет без request_started/request_finished:
+                # соединение проверяется (возвращается в пул) здесь
+                for connection in connections.all():
+                    connection.close_if_unusable_or_obsolete()
+
+    def _journal_line(self, key, changes):
+        user_id, book_id = key
+        return json.dumps({'user': user_id, 'book': book_id,
+                           'changes': changes}) + '\n'
+
+    def _open_journal(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        path = os.path.join(
+            self.journal_dir, JOURNAL_PATTERN.replace(
+                '*', f'{os.getpid()}-{uuid.uuid4().hex}')
+        )
+        journal = open(path, 'a+', encoding='utf-8')
+        # Пока процесс жив, журнал заблокирован: replay_journals других
+        # процессов его пропустит
+        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return journal
+
+    def _rewrite_journal(self):
+        if self._journal is None:
+            return
+        self._journal.seek(0)
+        self._journal.truncate()
+        self._journal.writelines(
+            self._journal_line(key, changes)
+            for key, changes in self._pending.items()
+        )
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def replay_journals(self):
+        """Применяет журналы завершившихся без сброса процессов и удаляет
+        их. Возвращает число примененных пар"""
+        applied = 0
+        for path in sorted(glob.glob(os.path.join(self.journal_dir,
+                                                  JOURNAL_PATTERN))):
+            try:
+                journal = open(path, encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            with journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Процесс жив
+                    continue
+                if os.fstat(journal.fileno()).st_nlink == 0:
+                    # Уже применен другим процессом
+                    continue
+                changes = {}
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Недописанная при падении строка
+                        continue
+                    changes.setdefault(
+                        (entry['user'], entry['book']), {}
+                    ).update(entry['changes'])
+                if changes:
+                    apply_relation_changes(changes)
+                os.unlink(path)
+                applied += len(changes)
+        return applied
+
+
+_write_behind = None
+# Буфер создается один раз на процесс: __init__ воспроизводит журналы и
+# запускает поток сброса, и второй буфер от параллельного первого запроса
+# прятал бы свои изменения от overlay() и flush_user_changes()
+_write_behind_lock = threading.Lock()
+
+
+def get_write_behind():
+    """WriteBehindBuffer по настройке BOOKS_WRITE_BEHIND, None - отложенная
+    запись выключена"""
+    global _write_behind
+    if _write_behind is None:
+        config = getattr(settings, 'BOOKS_WRITE_BEHIND', None)
+        if not config:
+            return None
+        with _write_behind_lock:
+            if _write_behind is None:
+                _write_behind = WriteBehindBuffer(
+                    flush_interval=config.get('FLUSH_INTERVAL', 1.0),
+                    max_pending=config.get('MAX_PENDING', 500),
+                    journal_dir=config.get('JOURNAL_DIR')
+                )
+    return _write_behind
+
+
+def flush_user_changes(user_id):
+    """Применяет отложенные изменения пользователя перед чтением или
+    синхронной записью его связей"""
+    write_behind = get_write_behind()
+    if write_behind is not None:
+        write_behind.flush(user_id)
+
+
+@receiver(setting_changed)
+def reset_write_behind(setting, **kwargs):
+    global _write_behind
+    if setting != 'BOOKS_WRITE_BEHIND':
+        return
+    with _write_behind_lock:
+        if _write_behind is not None:
+            _write_behind.stop()
+            _write_behind = None